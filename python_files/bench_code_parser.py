@@ -0,0 +1,335 @@
+import argparse
+import ast
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import code_parser
+
+
+def make_program(n_funcs, stmts_per_func=8, mutate_at=None):
+    """ Builds a program of n_funcs similar functions; mutate_at changes one statement """
+    lines = []
+    for f in range(n_funcs):
+        lines.append(f"def func_{f}(a, b):")
+        lines.append("    total = 0")
+        for s in range(stmts_per_func):
+            op = "-" if mutate_at == (f, s) else "+"
+            lines.append(f"    for i in range({s + 1}):")
+            lines.append(f"        if i % 2 == {s % 2}:")
+            lines.append(f"            total = total {op} a * i")
+        lines.append("    return total + b")
+        lines.append("")
+    return "\n".join(lines)
+
+
+# --- synthetic corpus ---------------------------------------------------------
+
+NAMES = ["a", "b", "c", "total", "best", "count", "acc", "tmp"]
+CALLS = ["print", "helper", "update", "record"]
+COMPARE_OPS = ["<", "<=", ">", ">=", "==", "!="]
+BIN_OPS = ["+", "-", "*", "//", "%"]
+
+
+def _expr(rng):
+    left, right = rng.choice(NAMES), rng.choice(NAMES + [str(rng.randint(0, 9))])
+    return f"{left} {rng.choice(BIN_OPS)} {right}"
+
+
+def _cond(rng):
+    return f"{rng.choice(NAMES)} {rng.choice(COMPARE_OPS)} {rng.randint(0, 9)}"
+
+
+def _block(rng, budget, depth, indent, spec):
+    """ Emits up to `budget` statements; returns (lines, statements used) """
+    pad = "    " * indent
+    lines, used = [], 0
+    while used < budget:
+        room = budget - used
+        if depth < spec["depth"] and room >= 3 and rng.random() < spec["nesting"]:
+            inner = max(1, min(room - 1, rng.randint(1, 4)))
+            if rng.random() < spec["loops"]:
+                if rng.random() < 0.5:
+                    lines.append(f"{pad}for i in range({rng.randint(1, 20)}):")
+                else:
+                    lines.append(f"{pad}while {_cond(rng)}:")
+                body, n = _block(rng, inner, depth + 1, indent + 1, spec)
+                lines += body
+                used += n + 1
+            else:
+                lines.append(f"{pad}if {_cond(rng)}:")
+                body, n = _block(rng, inner, depth + 1, indent + 1, spec)
+                lines += body
+                used += n + 1
+                for _ in range(spec["elif_chain"]):
+                    if used >= budget:
+                        break
+                    lines.append(f"{pad}elif {_cond(rng)}:")
+                    body, n = _block(rng, 1, depth + 1, indent + 1, spec)
+                    lines += body
+                    used += n + 1
+                lines.append(f"{pad}else:")
+                body, n = _block(rng, 1, depth + 1, indent + 1, spec)
+                lines += body
+                used += n + 1
+        elif rng.random() < 0.7:
+            lines.append(f"{pad}{rng.choice(NAMES)} = {_expr(rng)}")
+            used += 1
+        else:
+            lines.append(f"{pad}{rng.choice(CALLS)}({rng.choice(NAMES)}, {rng.randint(0, 9)})")
+            used += 1
+    return lines, used
+
+
+def make_reference(rng, spec):
+    """ A synthetic reference solution with spec["statements"] statements over spec["functions"] functions """
+    lines = []
+    per_func = max(1, spec["statements"] // spec["functions"])
+    for f in range(spec["functions"]):
+        lines.append(f"def solve_{f}(a, b, c):")
+        body, _ = _block(rng, per_func, 0, 1, spec)
+        lines += body
+        lines.append(f"    return {_expr(rng)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+class _Mutator(ast.NodeTransformer):
+    """ Applies small, student-like edits to roughly `rate` of the statements """
+
+    def __init__(self, rng, rate):
+        self.rng = rng
+        self.rate = rate
+
+    def _mutate_body(self, body):
+        out = []
+        for stmt in body:
+            self.visit(stmt)
+            roll = self.rng.random()
+            if roll >= self.rate:
+                out.append(stmt)
+                continue
+            kind = self.rng.randrange(4)
+            if kind == 0 and len(body) > 1:
+                continue  # dropped statement
+            if kind == 1:
+                out += [stmt, stmt]  # duplicated statement
+                continue
+            for node in ast.walk(stmt):
+                if isinstance(node, ast.Constant) and isinstance(node.value, int):
+                    node.value += 1
+                    break
+                if isinstance(node, ast.Compare):
+                    node.ops = [ast.Lt() if not isinstance(node.ops[0], ast.Lt) else ast.GtE()]
+                    break
+                if isinstance(node, ast.BinOp):
+                    node.op = ast.Sub() if not isinstance(node.op, ast.Sub) else ast.Add()
+                    break
+            out.append(stmt)
+        return out or body[:1]
+
+    def generic_visit(self, node):
+        for field in ("body", "orelse"):
+            if isinstance(getattr(node, field, None), list) and getattr(node, field):
+                setattr(node, field, self._mutate_body(getattr(node, field)))
+        return node
+
+
+def mutate(source, rng, rate):
+    tree = ast.parse(source)
+    _Mutator(rng, rate).visit(tree)
+    return ast.unparse(tree)
+
+
+def make_corpus(spec, pairs, mutation_rate, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(pairs):
+        reference = make_reference(rng, spec)
+        corpus.append((reference, mutate(reference, rng, mutation_rate)))
+    return corpus
+
+
+# --- measurement --------------------------------------------------------------
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "throughput_per_s": len(samples) / total if total else None,
+        "p50_ms": percentile(samples, 50) * 1e3,
+        "p95_ms": percentile(samples, 95) * 1e3,
+        "p99_ms": percentile(samples, 99) * 1e3,
+        "mean_ms": total / len(samples) * 1e3,
+    }
+
+
+def bench_pipeline(corpus):
+    """ analyze_code / compare_ast / generate_hints timed per stage, plus peak traced memory """
+    stages = {"analyze_reference": [], "analyze_student": [], "compare": [], "hints": [], "total": []}
+    sizes, diffs_found = [], []
+    for reference, student in corpus:
+        t0 = time.perf_counter()
+        opt = code_parser.analyze_code(reference)
+        t1 = time.perf_counter()
+        stu = code_parser.analyze_code(student)
+        t2 = time.perf_counter()
+        diffs = code_parser.compare_ast(opt, stu)
+        t3 = time.perf_counter()
+        code_parser.generate_hints(diffs)
+        t4 = time.perf_counter()
+
+        stages["analyze_reference"].append(t1 - t0)
+        stages["analyze_student"].append(t2 - t1)
+        stages["compare"].append(t3 - t2)
+        stages["hints"].append(t4 - t3)
+        stages["total"].append(t4 - t0)
+        sizes.append(opt.size + stu.size)
+        diffs_found.append(len(diffs))
+
+    # A separate pass so tracemalloc's overhead doesn't skew the timings
+    tracemalloc.start()
+    for reference, student in corpus:
+        code_parser.generate_hints(code_parser.compare_ast(
+            code_parser.analyze_code(reference), code_parser.analyze_code(student)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "stages": {name: summarize(samples) for name, samples in stages.items()},
+        "mean_tree_nodes": sum(sizes) / len(sizes),
+        "mean_diffs": sum(diffs_found) / len(diffs_found),
+        "peak_traced_memory_kib": peak / 1024,
+    }
+
+
+def bench_app(corpus):
+    """ The same pairs through the FastAPI app with an in-process test client """
+    from fastapi.testclient import TestClient
+
+    results = {}
+    with TestClient(code_parser.app) as client:
+        for route in ("/compare-code", "/compare-code/stream"):
+            samples, failures = [], 0
+            for reference, student in corpus:
+                start = time.perf_counter()
+                response = client.post(route, json={"student_code": student, "optimal_code": reference})
+                samples.append(time.perf_counter() - start)
+                failures += response.status_code != 200
+            results[route] = {**summarize(samples), "failures": failures}
+    return results
+
+
+def bench_near_identical(sizes, repeat):
+    """ One mutated statement in programs of growing size """
+    rows = []
+    for n in sizes:
+        reference = make_program(n)
+        student = make_program(n, mutate_at=(n // 2, 3))
+
+        analyze_s = min(_timed(code_parser.analyze_code, reference) for _ in range(repeat))
+        opt, stu = code_parser.analyze_code(reference), code_parser.analyze_code(student)
+        compare_s = min(_timed(code_parser.compare_ast, opt, stu) for _ in range(repeat))
+        rows.append({
+            "functions": n,
+            "lines": reference.count("\n") + 1,
+            "analyze_ms": analyze_s * 1e3,
+            "compare_ms": compare_s * 1e3,
+            "diffs": len(code_parser.compare_ast(opt, stu)),
+        })
+    return rows
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _print_stages(title, stages):
+    print(f"\n{title}")
+    print(f"  {'stage':<20} {'per s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in stages.items():
+        print(f"  {name:<20} {row['throughput_per_s']:>9.1f} {row['p50_ms']:>9.3f} "
+              f"{row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the code parser comparison pipeline")
+    parser.add_argument("--suite", choices=["pipeline", "app", "near-identical", "all"], default="pipeline")
+    parser.add_argument("--pairs", type=int, default=200, help="reference/student pairs per size")
+    parser.add_argument("--statements", type=int, nargs="+", default=[20, 100, 400])
+    parser.add_argument("--functions", type=int, default=2)
+    parser.add_argument("--depth", type=int, default=3, help="maximum block nesting depth")
+    parser.add_argument("--nesting", type=float, default=0.3, help="chance a statement opens a block")
+    parser.add_argument("--elif-chain", type=int, default=2, help="elif branches per if")
+    parser.add_argument("--loops", type=float, default=0.4, help="share of blocks that are loops")
+    parser.add_argument("--mutation-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="function counts for the near-identical suite")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "runs": [],
+    }
+
+    if args.suite in ("pipeline", "app", "all"):
+        for statements in args.statements:
+            spec = {
+                "statements": statements, "functions": args.functions, "depth": args.depth,
+                "nesting": args.nesting, "elif_chain": args.elif_chain, "loops": args.loops,
+            }
+            corpus = make_corpus(spec, args.pairs, args.mutation_rate, args.seed)
+            run = {"spec": spec, "pairs": len(corpus), "mutation_rate": args.mutation_rate}
+            if args.suite in ("pipeline", "all"):
+                run["pipeline"] = bench_pipeline(corpus)
+                _print_stages(f"pipeline, {statements} statements", run["pipeline"]["stages"])
+                print(f"  peak traced memory {run['pipeline']['peak_traced_memory_kib']:.0f} KiB, "
+                      f"{run['pipeline']['mean_tree_nodes']:.0f} nodes/pair, "
+                      f"{run['pipeline']['mean_diffs']:.1f} diffs/pair")
+            if args.suite in ("app", "all"):
+                run["app"] = bench_app(corpus)
+                _print_stages(f"app, {statements} statements", run["app"])
+            report["runs"].append(run)
+
+    if args.suite in ("near-identical", "all"):
+        report["near_identical"] = bench_near_identical(args.sizes, args.repeat)
+        print(f"\n{'funcs':>6} {'lines':>7} {'analyze ms':>11} {'compare ms':>11} {'diffs':>6}")
+        for row in report["near_identical"]:
+            print(f"{row['functions']:>6} {row['lines']:>7} {row['analyze_ms']:>11.2f} "
+                  f"{row['compare_ms']:>11.3f} {row['diffs']:>6}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nwrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import ast
+import time
+import tracemalloc
+
+from z3 import BoolVal, Int
+
+from generate_z3 import FeasibilityChecker, SymbolicStore, check_equivalence, extract_paths_from_code, symbolic_execute
+
+
+def make_branchy(depth, n_vars):
+    """ n_vars live variables and a full binary tree of `depth` nested if/else, so 2**depth paths """
+    lines = ["def f(a, b):"]
+    lines += [f"    v{v} = a + {v}" for v in range(n_vars)]
+
+    def nest(level, indent):
+        pad = "    " * indent
+        if level == depth:
+            return [f"{pad}return v0 + b"]
+        var = f"v{level % n_vars}"
+        return ([f"{pad}if a > {level}:", f"{pad}    {var} = {var} + b"] + nest(level + 1, indent + 1)
+                + [f"{pad}else:", f"{pad}    b = b - {level}"] + nest(level + 1, indent + 1))
+
+    lines += nest(0, 1)
+    return "\n".join(lines)
+
+
+def make_sequential(n_ifs, n_loops=0):
+    """ n_ifs independent if/else statements in a row, then a loop and a branch on the result.
+
+    Each if doubles the number of paths unless the states are merged at the join.
+    """
+    lines = ["def f(a, b):", "    x = 0", "    y = b"]
+    for k in range(n_ifs):
+        lines += [f"    if a > {k}:", f"        x = x + {k + 1}", "    else:", f"        y = y - {k}"]
+    for k in range(n_loops):
+        lines += [f"    while x < b + {k}:", "        x = x + 2"]
+    lines += ["    if x > y:", "        return x - y", "    return y"]
+    return "\n".join(lines)
+
+
+def explore(code, memory_factory, prune=False):
+    func = ast.parse(code).body[0]
+    memory = memory_factory({"a": Int("a"), "b": Int("b"), "i": Int("i")})
+    paths = []
+    symbolic_execute(func.body, memory, BoolVal(True), paths, FeasibilityChecker() if prune else None)
+    return paths
+
+
+def measure(code, memory_factory, prune=False):
+    start = time.perf_counter()
+    paths = explore(code, memory_factory, prune)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    explore(code, memory_factory, prune)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(paths), elapsed, peak
+
+
+def measure_merge(code, merge):
+    stats = {}
+    start = time.perf_counter()
+    extract_paths_from_code(code, prune=True, merge=merge, stats=stats)
+    stats["total_time"] = time.perf_counter() - start
+    return stats
+
+
+def merge_suite(sizes):
+    print(f"{'ifs':>4} {'loops':>5} {'merge':<7} {'paths':>6} {'merges':>6} {'checks':>7} "
+          f"{'solver ms':>10} {'total ms':>9}")
+    for n_ifs in sizes:
+        for n_loops in (0, 1):
+            code = make_sequential(n_ifs, n_loops)
+            for merge in ("never", "auto", "always"):
+                stats = measure_merge(code, merge)
+                print(f"{n_ifs:>4} {n_loops:>5} {merge:<7} {stats['paths']:>6} {stats['merges']:>6} "
+                      f"{stats['solver_checks']:>7} {stats['solver_time'] * 1e3:>10.1f} {stats['total_time'] * 1e3:>9.1f}")
+
+
+# (name, target, user) pairs; the arithmetic ones are nonlinear over Int
+THEORY_EXERCISES = [
+    ("lowest bit", "def f(a): return a & 1", "def f(a): return a % 2"),
+    ("power of two", "def f(a): return a > 0 and (a & (a - 1)) == 0",
+     "def f(a):\n    if a <= 0:\n        return False\n    return (a & -a) == a"),
+    ("swap xor", "def f(a, b): return a ^ b ^ b", "def f(a, b): return a"),
+    ("shift multiply", "def f(a): return a << 3", "def f(a): return a * 8"),
+    ("mod product", "def f(a, b): return (a * b) % 7", "def f(a, b): return ((a % 7) * (b % 7)) % 7"),
+    ("floor average", "def f(a, b): return (a + b) // 2", "def f(a, b): return a // 2 + b // 2 + (a % 2 + b % 2) // 2"),
+    ("cubes", "def f(a, b): return (a + b) * (a + b) * (a + b)",
+     "def f(a, b): return a * a * a + 3 * a * a * b + 3 * a * b * b + b * b * b"),
+    # Int times out and bit-vectors only find an overflow counterexample, which Python doesn't reproduce
+    ("fermat n=3", "def f(a, b, c): return a * a * a + b * b * b != c * c * c or a * b * c <= 0",
+     "def f(a, b, c): return True"),
+    ("digit sum mod 9", "def f(a): return (a % 10 + a // 10 % 10) % 9", "def f(a): return (a % 10 + (a // 10) % 10) % 9"),
+]
+
+
+def theory_suite(timeout_ms):
+    print(f"{'exercise':<16} {'theory':<8} {'used':<12} {'verdict':<11} {'ms':>9}")
+    for name, target, user in THEORY_EXERCISES:
+        for theory in ("int", "bitvec", "auto"):
+            start = time.perf_counter()
+            try:
+                result = check_equivalence(target, user, timeout_ms=timeout_ms, theory=theory)
+                # Code the theory can't express is checked by differential testing instead
+                used, verdict = result.get("theory", result["method"]), result["verdict"]
+            except NotImplementedError:
+                used, verdict = "-", "unsupported"
+            print(f"{name:<16} {theory:<8} {used:<12} {verdict:<11} {(time.perf_counter() - start) * 1e3:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the symbolic executor")
+    parser.add_argument("--depths", type=int, nargs="+", default=[4, 6, 8])
+    parser.add_argument("--vars", type=int, nargs="+", default=[5, 50])
+    parser.add_argument("--ifs", type=int, nargs="+", default=[4, 8],
+                        help="sizes of the sequential-if functions for the merge comparison")
+    parser.add_argument("--timeout-ms", type=int, default=5000, help="per solver call in the theory suite")
+    parser.add_argument("--suite", choices=["store", "merge", "theory", "all"], default="all")
+    args = parser.parse_args()
+
+    if args.suite in ("theory", "all"):
+        theory_suite(args.timeout_ms)
+        if args.suite == "theory":
+            return
+        print()
+
+    if args.suite in ("merge", "all"):
+        merge_suite(args.ifs)
+        if args.suite == "merge":
+            return
+        print()
+
+    stores = {"deepcopy dict": (dict, False), "SymbolicStore": (SymbolicStore, False),
+              "Store + prune": (SymbolicStore, True)}
+    print(f"{'depth':>5} {'vars':>5} {'store':<14} {'paths':>6} {'ms/path':>9} {'KiB/path':>9} {'total ms':>9}")
+    for n_vars in args.vars:
+        for depth in args.depths:
+            code = make_branchy(depth, n_vars)
+            for name, (factory, prune) in stores.items():
+                paths, elapsed, peak = measure(code, factory, prune)
+                print(f"{depth:>5} {n_vars:>5} {name:<14} {paths:>6} "
+                      f"{elapsed / paths * 1e3:>9.3f} {peak / paths / 1024:>9.1f} {elapsed * 1e3:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from generate_z3 import check_equivalence
+from run_z3_tests import run_case_subprocess
+
+FAMILIES = ("branches", "while", "for", "tuples", "arrays", "bitwise")
+
+
+def _function(params, body):
+    return "\n".join([f"def f({', '.join(params)}):"] + ["    " + line for line in body])
+
+
+def _case(family, name, target, user, params, expected):
+    return {"name": f"{family}/{name}", "family": family, "code": target, "user_code": user,
+            "variables": list(params), "expected": expected}
+
+
+def branch_cases(rng, n_ifs):
+    """ n_ifs independent updates of an accumulator, and five rewrites: three equivalent, two not """
+    tests = [(rng.choice("ab"), rng.choice([">", "<", ">=", "<=", "=="]), rng.randint(-20, 20), rng.randint(1, 9))
+             for _ in range(n_ifs)]
+    flipped = {">": "<", "<": ">", ">=": "<=", "<=": ">=", "==": "=="}
+    negated = {">": "<=", "<": ">=", ">=": "<", "<=": ">", "==": "!="}
+
+    def body(update, skip=None):
+        lines = ["r = b"]
+        for k, test in enumerate(tests):
+            if k != skip:
+                lines += update(k, *test)
+        return lines + ["return r"]
+
+    target = _function("ab", body(lambda k, v, op, c, d: [f"if {v} {op} {c}:", f"    r = r + {d}"]))
+    rewrites = {
+        "flipped": (body(lambda k, v, op, c, d: [f"if {c} {flipped[op]} {v}:", f"    r = r + {d}"]), "equivalent"),
+        "negated": (body(lambda k, v, op, c, d: [f"if {v} {negated[op]} {c}:", "    pass", "else:",
+                                                 f"    r = {d} + r"]), "equivalent"),
+        "temps": (body(lambda k, v, op, c, d: [f"t{k} = {d}", f"if {v} {op} {c}:", f"    r = r + t{k}",
+                                               "else:", "    r = r + 0"]), "equivalent"),
+        "off_by_one": (body(lambda k, v, op, c, d: [f"if {v} {op} {c + (1 if k == 0 else 0)}:",
+                                                    f"    r = r + {d}"]), "different"),
+        "dropped": (body(lambda k, v, op, c, d: [f"if {v} {op} {c}:", f"    r = r + {d}"], skip=n_ifs - 1),
+                    "different"),
+    }
+    return [_case("branches", f"{n_ifs}ifs_{name}", target, _function("ab", lines), "ab", expected)
+            for name, (lines, expected) in rewrites.items()]
+
+
+def while_cases(rng, depth):
+    """ A counted while loop against its closed form, with a concrete and a symbolic trip count """
+    step = rng.randint(1, 5)
+    target = _function("ab", ["s = b", "i = 0", f"while i < {depth}:", f"    s = s + a * {step}",
+                              "    i = i + 1", "return s"])
+    # Unrolled past MAX_WHILE_UNROLL when depth is large, so these also show what truncation costs
+    symbolic = _function("ab", ["s = 0", "i = 0", f"while i < b and i < {depth}:", f"    s = s + {step}",
+                                "    i = i + 1", "return s"])
+    clamped = _function("ab", ["if b <= 0:", "    return 0", f"if b > {depth}:", f"    return {step * depth}",
+                               f"return b * {step}"])
+    return [
+        _case("while", f"unroll{depth}_closed", target, _function("ab", [f"return b + a * {step * depth}"]),
+              "ab", "equivalent"),
+        _case("while", f"unroll{depth}_short", target, _function("ab", [f"return b + a * {step * (depth - 1)}"]),
+              "ab", "different"),
+        _case("while", f"unroll{depth}_symbolic", symbolic, clamped, "ab", "equivalent"),
+        _case("while", f"unroll{depth}_symbolic_off", symbolic, clamped.replace(f"b > {depth}", f"b >= {depth}")
+              .replace(f"return {step * depth}", f"return {step * depth - 1}"), "ab", "different"),
+    ]
+
+
+def for_cases(rng, depth):
+    """ range() loops: a triangular sum against its closed form, and a loop-carried branch """
+    scale = rng.randint(1, 4)
+    target = _function("ab", ["s = 0", f"for k in range({depth}):", f"    s = s + k * a * {scale}", "return s + b"])
+    triangular = depth * (depth - 1) // 2 * scale
+    counted = _function("ab", ["n = 0", f"for k in range({depth}):", "    if a > k:", "        n = n + 1",
+                               "return n"])
+    clamped = _function("ab", ["if a <= 0:", "    return 0", f"if a >= {depth}:", f"    return {depth}",
+                               "return a"])
+    return [
+        _case("for", f"range{depth}_closed", target, _function("ab", [f"return a * {triangular} + b"]),
+              "ab", "equivalent"),
+        _case("for", f"range{depth}_past_end", target,
+              _function("ab", [f"return a * {(depth + 1) * depth // 2 * scale} + b"]), "ab", "different"),
+        _case("for", f"range{depth}_count", counted, clamped, "ab", "equivalent"),
+        _case("for", f"range{depth}_count_off", counted, clamped.replace(f"return {depth}", f"return {depth + 1}"),
+              "ab", "different"),
+    ]
+
+
+def tuple_cases(rng):
+    """ Tuple returns and unpacking """
+    c = rng.randint(1, 9)
+    target = _function("ab", [f"x, y = a + {c}, b - {c}", "if x > y:", "    return x, y", "return y, x"])
+    return [
+        _case("tuples", f"sort_pair{c}", target,
+              _function("ab", [f"if a + {2 * c} > b:", f"    return a + {c}, b - {c}", f"return b - {c}, a + {c}"]),
+              "ab", "equivalent"),
+        _case("tuples", f"swap{c}", target, _function("ab", [f"x, y = b - {c}, a + {c}", "y, x = x, y",
+                                                             "if x > y:", "    return x, y", "return y, x"]),
+              "ab", "equivalent"),
+        _case("tuples", f"unsorted{c}", target, _function("ab", [f"return a + {c}, b - {c}"]), "ab", "different"),
+    ]
+
+
+def array_cases(rng):
+    """ List inputs, which the symbolic executor hands over to differential testing """
+    c = rng.randint(1, 5)
+    target = _function(["xs"], ["best = xs[0]", "for x in xs:", "    if x > best:", "        best = x",
+                                f"return best + {c}"])
+    return [
+        _case("arrays", f"max{c}", target, _function(["xs"], [f"return sorted(xs)[-1] + {c}"]), ["xs"], "equivalent"),
+        _case("arrays", f"max_from_zero{c}", target,
+              _function(["xs"], ["best = 0", "for x in xs:", "    if x > best:", "        best = x",
+                                 f"return best + {c}"]), ["xs"], "different"),
+    ]
+
+
+def bitwise_cases(rng):
+    """ Bit tricks, checked over bit-vectors """
+    shift = rng.randint(1, 6)
+    mask = rng.choice([1, 3, 7, 15, 255])
+    return [
+        _case("bitwise", f"shift{shift}", _function("a", [f"return a << {shift}"]),
+              _function("a", [f"return a * {2 ** shift}"]), "a", "equivalent"),
+        _case("bitwise", f"mask{mask}", _function("a", [f"return a & {mask}"]),
+              _function("a", [f"return a % {mask + 1}"]), "a", "equivalent"),
+        _case("bitwise", f"mask{mask}_off", _function("a", [f"return a & {mask}"]),
+              _function("a", [f"return a % {mask}"]), "a", "different"),
+        _case("bitwise", f"xor_swap{shift}", _function("ab", [f"return a ^ b ^ {shift}"]),
+              _function("ab", [f"return b ^ {shift} ^ a"]), "ab", "equivalent"),
+    ]
+
+
+def make_corpus(seed=0, rounds=4, families=FAMILIES):
+    """ Target/user pairs with known verdicts; the same seed always gives the same corpus """
+    rng = random.Random(seed)
+    corpus = []
+    for r in range(rounds):
+        for family in families:
+            if family == "branches":
+                cases = [case for n_ifs in range(2, 9) for case in branch_cases(rng, n_ifs)]
+            elif family == "while":
+                cases = [case for depth in range(1, 7) for case in while_cases(rng, depth)]
+            elif family == "for":
+                cases = [case for depth in range(1, 7) for case in for_cases(rng, depth)]
+            elif family == "tuples":
+                cases = tuple_cases(rng)
+            elif family == "arrays":
+                cases = array_cases(rng)
+            else:
+                cases = bitwise_cases(rng)
+            corpus += [{**case, "name": f"{case['name']}#{r}"} for case in cases]
+    return corpus
+
+
+def summarize(result, wall, usage):
+    """ The per-case numbers tracked across commits """
+    timings = result.get("timings", {})
+    paths = result.get("paths", {})
+    return {
+        "verdict": result.get("verdict"),
+        "method": result.get("method"),
+        "theory": result.get("theory"),
+        "paths_target": paths.get("target"),
+        "paths_user": paths.get("user"),
+        "solver_checks": result.get("solver_checks", 0),
+        "solver_time": result.get("solver_time", 0.0),
+        "check_time": timings.get("total"),
+        "wall_time": wall,
+        "peak_rss_kib": usage.ru_maxrss if usage is not None else None,
+    }
+
+
+def run_inprocess(case, timeout_ms):
+    """ check_equivalence in a forked child, so its peak RSS can be read back from wait4 """
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            payload = json.dumps(check_equivalence(case["code"], case["user_code"], case["variables"],
+                                                   timeout_ms=timeout_ms))
+        except Exception as e:
+            payload = json.dumps({"error": f"{type(e).__name__}: {e}"})
+        with os.fdopen(write_fd, "w") as f:
+            f.write(payload)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        payload = f.read()
+    _, _, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    result = json.loads(payload) if payload else {"error": "worker exited without a result"}
+    return result, wall, usage
+
+
+def run_subprocess(case, timeout_ms):
+    """ The generate_z3.py command line, as run_z3_tests.py --subprocess runs it """
+    start = time.perf_counter()
+    stdout, stderr, usage = run_case_subprocess(case)
+    wall = time.perf_counter() - start
+    try:
+        result = json.loads(stdout)
+    except ValueError:
+        result = {"error": stderr.splitlines()[-1] if stderr else "no output"}
+    return result, wall, usage
+
+
+MODES = {"inprocess": run_inprocess, "subprocess": run_subprocess}
+
+
+def run_corpus(corpus, modes, timeout_ms):
+    rows = []
+    for case in corpus:
+        for mode in modes:
+            result, wall, usage = MODES[mode](case, timeout_ms)
+            row = {"name": case["name"], "family": case["family"], "mode": mode, "expected": case["expected"],
+                   **summarize(result, wall, usage)}
+            if "error" in result:
+                row["error"] = result["error"]
+            row["correct"] = None if row["verdict"] in (None, "unknown") else row["verdict"] == case["expected"]
+            rows.append(row)
+            print(f"{mode:<10} {case['name']:<36} {row['verdict'] or 'error':<11} {row['method'] or '-':<12} "
+                  f"{row['solver_checks']:>4} {row['solver_time'] * 1e3:>9.1f} {wall * 1e3:>9.1f} "
+                  f"{row['peak_rss_kib'] or 0:>8}", flush=True)
+    return rows
+
+
+def _quantile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+def summary(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["mode"], row["family"]), []).append(row)
+        groups.setdefault((row["mode"], "all"), []).append(row)
+    table = []
+    for (mode, family), group in sorted(groups.items()):
+        walls = [row["wall_time"] for row in group]
+        table.append({
+            "mode": mode,
+            "family": family,
+            "cases": len(group),
+            "correct": sum(row["correct"] is True for row in group),
+            "wrong": sum(row["correct"] is False for row in group),
+            "unknown": sum(row["correct"] is None for row in group),
+            "solver_checks": sum(row["solver_checks"] for row in group),
+            "solver_time": sum(row["solver_time"] for row in group),
+            "wall_time": sum(walls),
+            "wall_p50": _quantile(walls, 50),
+            "wall_p95": _quantile(walls, 95),
+            "peak_rss_kib": max(row["peak_rss_kib"] or 0 for row in group),
+        })
+    return table
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark corpus for the symbolic equivalence checker")
+    parser.add_argument("--mode", choices=["inprocess", "subprocess", "both"], default="inprocess")
+    parser.add_argument("--rounds", type=int, default=4, help="copies of each family, with different constants")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--family", choices=FAMILIES, nargs="+", default=list(FAMILIES))
+    parser.add_argument("--limit", type=int, default=None, help="only run the first N cases")
+    parser.add_argument("--timeout-ms", type=int, default=5000, help="per solver call, in-process only")
+    parser.add_argument("--dump-corpus", help="write the corpus in code_snippets.json format and exit")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.seed, args.rounds, args.family)[:args.limit]
+    if args.dump_corpus:
+        with open(args.dump_corpus, "w") as f:
+            json.dump(corpus, f, indent=2)
+        print(f"wrote {len(corpus)} cases to {args.dump_corpus}")
+        return
+
+    modes = ["inprocess", "subprocess"] if args.mode == "both" else [args.mode]
+    print(f"{'mode':<10} {'case':<36} {'verdict':<11} {'method':<12} {'chk':>4} {'solver ms':>9} "
+          f"{'wall ms':>9} {'rss KiB':>8}")
+    rows = run_corpus(corpus, modes, args.timeout_ms)
+
+    table = summary(rows)
+    print(f"\n{'mode':<10} {'family':<9} {'cases':>5} {'ok':>4} {'wrong':>5} {'unk':>4} {'solver s':>9} "
+          f"{'wall s':>8} {'p95 ms':>8} {'rss KiB':>8}")
+    for line in table:
+        print(f"{line['mode']:<10} {line['family']:<9} {line['cases']:>5} {line['correct']:>4} {line['wrong']:>5} "
+              f"{line['unknown']:>4} {line['solver_time']:>9.2f} {line['wall_time']:>8.2f} "
+              f"{line['wall_p95'] * 1e3:>8.1f} {line['peak_rss_kib']:>8}")
+
+    if args.output:
+        report = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "params": vars(args),
+            "summary": table,
+            "cases": rows,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nwrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,104 @@
 import ast
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing.util
+import os
+import random
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Literal, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
+from plagiarism_index import FingerprintIndex, source_signature
+from differential_testing import WORKER_MEMORY_BYTES, SandboxOverrun, limit_worker_memory
+from generate_z3 import SolverPortfolio, check_equivalence
+from verdict_cache import VerdictCache
+from metrics import CONTENT_TYPE, LATENCY_BUCKETS, Counter, Gauge, Histogram, render_metrics
+
+logger = logging.getLogger("code_parser")
+
+# Fraction of /compare-code requests whose trees and diffs are dumped to the
+# debug log. Off by default; dumping unparses every expression in both trees.
+DEBUG_SAMPLE_RATE = float(os.environ.get("CODE_PARSER_DEBUG_SAMPLE_RATE", "0"))
+
+# Limits on untrusted submissions, and on how much work may queue up for the
+# analysis workers before new requests are turned away
+MAX_SOURCE_BYTES = int(os.environ.get("CODE_PARSER_MAX_SOURCE_BYTES", str(64 * 1024)))
+MAX_AST_DEPTH = int(os.environ.get("CODE_PARSER_MAX_AST_DEPTH", "150"))
+CPU_LIMIT_SECONDS = float(os.environ.get("CODE_PARSER_CPU_LIMIT_SECONDS", "2"))
+WORKERS = int(os.environ.get("CODE_PARSER_WORKERS", str(os.cpu_count() or 1)))
+MAX_PENDING = int(os.environ.get("CODE_PARSER_MAX_PENDING", str(WORKERS * 4)))
+RETRY_AFTER_SECONDS = int(os.environ.get("CODE_PARSER_RETRY_AFTER_SECONDS", "2"))
+
+# Equivalence checks run Z3; each solver call gets the timeout, the whole
+# check the CPU limit, and the request (including time queued for a worker
+# and spent waiting on solver processes) the deadline
+EQUIVALENCE_TIMEOUT_MS = int(os.environ.get("CODE_PARSER_EQUIVALENCE_TIMEOUT_MS", "5000"))
+EQUIVALENCE_CPU_LIMIT_SECONDS = float(os.environ.get("CODE_PARSER_EQUIVALENCE_CPU_LIMIT_SECONDS", "10"))
+EQUIVALENCE_DEADLINE_SECONDS = float(os.environ.get("CODE_PARSER_EQUIVALENCE_DEADLINE_SECONDS",
+                                                    str(EQUIVALENCE_CPU_LIMIT_SECONDS)))
+# Comma-separated SolverPortfolio strategies to race on each query, e.g.
+# "simplify-smt,nlsat,bitblast". Each analysis worker then runs one solver
+# process per strategy, so leave it empty on machines without spare cores.
+SOLVER_PORTFOLIO = [name for name in os.environ.get("CODE_PARSER_SOLVER_PORTFOLIO", "").split(",") if name]
+# Submitted functions are only ever run (for differential testing) in
+# these processes, which are started by each analysis worker and have
+# their address space capped
+SANDBOX_WORKERS = int(os.environ.get("CODE_PARSER_SANDBOX_WORKERS", "1"))
+SANDBOX_MEMORY_BYTES = int(os.environ.get("CODE_PARSER_SANDBOX_MEMORY_BYTES", str(WORKER_MEMORY_BYTES)))
+VERDICT_CACHE_PATH = os.environ.get("VERDICT_CACHE_PATH", "verdict_cache.sqlite3")
+VERDICT_CACHE_MAX_BYTES = int(os.environ.get("VERDICT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+PLAGIARISM_INDEX_DIR = os.environ.get("PLAGIARISM_INDEX_DIR", "plagiarism_index")
 
 class Code(BaseModel):
     student_code: str
     optimal_code: str
 
+class CodeStream(Code):
+    hint_limit: Optional[int] = None
+
+class EquivalenceCheck(Code):
+    variables: Optional[List[str]] = None
+    timeout_ms: Optional[int] = Field(default=None, gt=0)
+    theory: Literal["auto", "int", "real", "bitvec"] = "auto"
+
+class CodeBatch(BaseModel):
+    optimal_code: str
+    student_codes: List[str]
+
+class PlagiarismSubmission(BaseModel):
+    submission_id: str
+    code: str
+    top_k: int = 5
+
+class PlagiarismQuery(BaseModel):
+    code: str
+    top_k: int = 5
+    min_similarity: Optional[float] = 0.0
+
+class SessionStart(BaseModel):
+    optimal_code: str
+
+class SessionEdit(BaseModel):
+    # Either the full program in `code`, or `text` replacing lines
+    # start_line..end_line (1-based, inclusive; end_line = start_line - 1 inserts)
+    code: Optional[str] = None
+    start_line: Optional[int] = None
+    end_line: Optional[int] = None
+    text: Optional[str] = None
+
 app = FastAPI()
 
 origins = [
@@ -23,6 +114,127 @@ app.add_middleware(
     allow_headers=["*"],              # Allow all headers
 )
 
+_CLOSE = object()
+
+def expr_fingerprint(node):
+    """ Structural digest of an expression, stable across processes """
+    h = hashlib.blake2b(digest_size=16)
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if item is _CLOSE:
+            h.update(b")")
+        elif isinstance(item, ast.expr_context):
+            continue
+        elif isinstance(item, ast.AST):
+            h.update(type(item).__name__.encode())
+            h.update(b"(")
+            stack.append(_CLOSE)
+            stack.extend(getattr(item, field, None) for field in reversed(item._fields))
+        elif isinstance(item, list):
+            h.update(b"[%d" % len(item))
+            stack.extend(reversed(item))
+        else:
+            h.update(repr(item).encode())
+            h.update(b",")
+    return h.digest()
+
+class ExprRef:
+    """ An expression compared by fingerprint and only unparsed when shown in a hint """
+    __slots__ = ("node", "fingerprint", "_text")
+
+    def __init__(self, node):
+        self.node = node
+        self.fingerprint = expr_fingerprint(node)
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = ast.unparse(self.node)
+        return self._text
+
+    def __eq__(self, other):
+        return isinstance(other, ExprRef) and self.fingerprint == other.fingerprint
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return repr(self.text)
+
+def _hash_field(h, val):
+    if val is None:
+        h.update(b"~")
+    elif isinstance(val, ExprRef):
+        h.update(val.fingerprint)
+    elif isinstance(val, Node):
+        h.update(val.hash)
+    elif isinstance(val, list):
+        h.update(b"[%d" % len(val))
+        for v in val:
+            _hash_field(h, v)
+    else:
+        h.update(repr(val).encode())
+    h.update(b",")
+
+class Node:
+    """ Compact analysis node; only the fields relevant to its type are set.
+
+    `hash` is a Merkle digest over the node's fields and its children's
+    digests, so two subtrees with equal hashes are structurally identical.
+    Nodes are built bottom-up, which lets it (and `size`, the number of
+    nodes in the subtree) be computed on construction.
+    """
+    __slots__ = ("type", "children", "name", "args", "condition", "target", "iter", "value", "func",
+                 "hash", "size")
+
+    def __init__(self, type, children=(), name=None, args=None, condition=None,
+                 target=None, iter=None, value=None, func=None):
+        self.type = type
+        self.children = children
+        self.name = name
+        self.args = args
+        self.condition = condition
+        self.target = target
+        self.iter = iter
+        self.value = value
+        self.func = func
+
+        h = hashlib.blake2b(type.encode(), digest_size=16)
+        for field in ("name", "args", "condition", "target", "iter", "value", "func"):
+            _hash_field(h, getattr(self, field))
+        h.update(b"[%d" % len(children))
+        size = 1 + (value.size if isinstance(value, Node) else 0)
+        for child in children:
+            h.update(child.hash)
+            size += child.size
+        self.hash = h.digest()
+        self.size = size
+
+    def to_dict(self):
+        out = {"type": self.type}
+        for field in self.__slots__[2:-2]:
+            val = getattr(self, field)
+            if val is None:
+                continue
+            if isinstance(val, Node):
+                val = val.to_dict()
+            elif isinstance(val, ExprRef):
+                val = val.text
+            elif isinstance(val, list):
+                val = [v.text if isinstance(v, ExprRef) else v for v in val]
+            out[field] = val
+        if self.children or self.type in ("module", "if", "elif", "else", "while", "for", "function_def"):
+            out["children"] = [child.to_dict() for child in self.children]
+        return out
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
 class CodeAnalyzer(ast.NodeVisitor):
     def __init__(self):
         self.returns = {}
@@ -39,98 +251,247 @@ class CodeAnalyzer(ast.NodeVisitor):
         return self.visit(node)
     
     def generic_visit(self, node):
-        return {"type": type(node).__name__, "children": []}
+        return Node(type(node).__name__)
 
     def visit_Module(self, node):
-            return {"type": "module", "children": [self.visit(stmt) for stmt in node.body]}
+            return Node("module", [self.visit(stmt) for stmt in node.body])
 
     def visit_If(self, node):
         blocks = []
 
         # Add the initial if
-        blocks.append({
-            "type": "if",
-            "condition": ast.unparse(node.test),
-            "children": [self.visit(stmt) for stmt in node.body]
-        })
+        blocks.append(Node(
+            "if",
+            [self.visit(stmt) for stmt in node.body],
+            condition=ExprRef(node.test),
+        ))
 
         # Walk through orelse to handle elif / else
         current = node
         while current.orelse:
             if isinstance(current.orelse[0], ast.If):
                 current = current.orelse[0]
-                blocks.append({
-                    "type": "elif",
-                    "condition": ast.unparse(current.test),
-                    "children": [self.visit(stmt) for stmt in current.body]
-                })
+                blocks.append(Node(
+                    "elif",
+                    [self.visit(stmt) for stmt in current.body],
+                    condition=ExprRef(current.test),
+                ))
             else:
                 # Final else
-                blocks.append({
-                    "type": "else",
-                    "children": [self.visit(stmt) for stmt in current.orelse]
-                })
+                blocks.append(Node("else", [self.visit(stmt) for stmt in current.orelse]))
                 break
 
         return blocks[0]  # You can choose to return a list or inject this logic into a parent node
 
 
     def visit_While(self, node):
-        return {
-            "type": "while",
-            "condition": ast.unparse(node.test),
-            "children": [self.visit(stmt) for stmt in node.body],
-        }
+        return Node(
+            "while",
+            [self.visit(stmt) for stmt in node.body],
+            condition=ExprRef(node.test),
+        )
 
     def visit_For(self, node):
-        return {
-            "type": "for",
-            "target": ast.unparse(node.target),
-            "iter": ast.unparse(node.iter),
-            "children": [self.visit(stmt) for stmt in node.body],
-        }
+        return Node(
+            "for",
+            [self.visit(stmt) for stmt in node.body],
+            target=ExprRef(node.target),
+            iter=ExprRef(node.iter),
+        )
 
     def visit_Assign(self, node):
-        return {
-            "type": "assign",
-            "target": ast.unparse(node.targets[0]),
-            "value": ast.unparse(node.value),
-        }
+        return Node(
+            "assign",
+            target=ExprRef(node.targets[0]),
+            value=ExprRef(node.value),
+        )
     
     def visit_Call(self, node):
-        return {
-            "type": "call",
-            "func": ast.unparse(node.func),
-            "args": [ast.unparse(arg) for arg in node.args],
-        }
+        return Node(
+            "call",
+            func=ExprRef(node.func),
+            args=[ExprRef(arg) for arg in node.args],
+        )
 
     def visit_Expr(self, node):
-        return {
-            "type": "expr",
-            "value": self.visit(node.value)
-        }
+        return Node("expr", value=self.visit(node.value))
 
     def visit_FunctionDef(self, node):
-        return {
-            "type": "function_def",
-            "name": node.name,
-            "args": [arg.arg for arg in node.args.args],
-            "children": [self.visit(stmt) for stmt in node.body],
-        }
+        return Node(
+            "function_def",
+            [self.visit(stmt) for stmt in node.body],
+            name=node.name,
+            args=[arg.arg for arg in node.args.args],
+        )
 
     def visit_Return(self, node):
-        return {
-            "type": "return",
-            "value": ast.unparse(node.value) if node.value else None,
-        }
+        return Node("return", value=ExprRef(node.value) if node.value else None)
+
+class AnalysisRejected(Exception):
+    """ A submission that is too large, too deeply nested or too slow to analyze """
+
+    def __init__(self, status_code, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def check_source_size(code):
+    if len(code) > MAX_SOURCE_BYTES or len(code.encode("utf-8")) > MAX_SOURCE_BYTES:
+        raise AnalysisRejected(413, f"Source exceeds {MAX_SOURCE_BYTES} bytes")
+
+def check_depth(tree, max_depth):
+    stack = [(tree, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if depth > max_depth:
+            raise AnalysisRejected(422, f"Source is nested more than {max_depth} levels deep")
+        stack.extend((child, depth + 1) for child in ast.iter_child_nodes(node))
+
+@contextmanager
+def cpu_time_limit(seconds):
+    """ Aborts the block once the process has used `seconds` of CPU; main thread of a worker only """
+    if (not seconds or not hasattr(signal, "setitimer")
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def exceeded(signum, frame):
+        raise AnalysisRejected(422, f"Analysis exceeded the {seconds}s CPU time limit")
+
+    previous = signal.signal(signal.SIGPROF, exceeded)
+    signal.setitimer(signal.ITIMER_PROF, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
 
-def analyze_code(code):
+def analyze_code(code, timings=None, max_depth=None):
+    start = time.perf_counter()
     tree = ast.parse(code)
+    if max_depth is not None:
+        check_depth(tree, max_depth)
+    parsed = time.perf_counter()
     builder = CodeAnalyzer()
-    return builder.build(tree)
+    result = builder.build(tree)
+    if timings is not None:
+        timings["parse"] = timings.get("parse", 0.0) + parsed - start
+        timings["analyze"] = timings.get("analyze", 0.0) + time.perf_counter() - parsed
+    return result
+
+def analyze_submission(code, timings=None):
+    """ analyze_code with the size and nesting limits for untrusted input """
+    check_source_size(code)
+    try:
+        return analyze_code(code, timings, max_depth=MAX_AST_DEPTH)
+    except SyntaxError as e:
+        raise AnalysisRejected(400, f"SyntaxError: {e}")
+    except (RecursionError, MemoryError):
+        raise AnalysisRejected(422, "Source is too deeply nested to analyze")
+
+class AnalysisCache:
+    """ Bounded LRU cache of analyzed trees, keyed by a hash of the source.
+
+    Safe to share between threads; analysis runs outside the lock, so two
+    threads missing on the same source may both analyze it.
+    """
+
+    def __init__(self, max_entries=256, analyze=analyze_code):
+        self.max_entries = max_entries
+        self.analyze = analyze
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(code):
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+    def get(self, code, timings=None):
+        key = self.key(code)
+        with self._lock:
+            tree = self._entries.get(key)
+            if tree is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tree
+            self.misses += 1
+
+        tree = self.analyze(code, timings)
+        with self._lock:
+            self._entries[key] = tree
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return tree
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# Reference solutions are shared by every student working on a problem, so
+# their analysis is only done once. Trees in here must never be mutated.
+reference_cache = AnalysisCache(analyze=analyze_submission)
+
+stage_latency = Histogram(
+    "code_parser_stage_seconds", "Time spent in each /compare-code stage",
+    LATENCY_BUCKETS, labelnames=("stage",))
+request_latency = Histogram(
+    "code_parser_request_seconds", "Wall-clock /compare-code handler time, including the wait for a worker",
+    LATENCY_BUCKETS)
+tree_size = Histogram(
+    "code_parser_tree_nodes", "Analysis tree size in nodes",
+    (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000), labelnames=("side",))
+diff_count = Histogram(
+    "code_parser_diffs", "Diffs found per comparison", (0, 1, 2, 5, 10, 25, 50, 100, 500))
+
+rejections = Counter(
+    "code_parser_rejections_total", "Requests refused by status code", labelnames=("status",))
+worker_cache_lookups = Counter(
+    "code_parser_worker_reference_cache_total", "Reference cache lookups in the analysis workers",
+    labelnames=("result",))
+equivalence_checks = Counter(
+    "code_parser_equivalence_checks_total", "Equivalence checks by verdict", labelnames=("verdict",))
+verdict_cache_lookups = Counter(
+    "code_parser_verdict_cache_total", "Verdict cache lookups for equivalence checks",
+    labelnames=("result",))
+solver_strategy_wins = Counter(
+    "code_parser_solver_strategy_wins_total", "Path queries decided first by each portfolio strategy",
+    labelnames=("strategy",))
+equivalence_latency = Histogram(
+    "code_parser_equivalence_seconds", "Time spent in symbolic execution and Z3 per equivalence check",
+    LATENCY_BUCKETS)
+
+def record_request(timings, elapsed, optimal_size, student_size, n_diffs):
+    for stage, seconds in timings.items():
+        stage_latency.observe(seconds, stage=stage)
+    request_latency.observe(elapsed)
+    tree_size.observe(optimal_size, side="optimal")
+    tree_size.observe(student_size, side="student")
+    diff_count.observe(n_diffs)
+
+def maybe_dump_trees(optimal_analysis, student_analysis, diffs):
+    """ Sampled debug dump of a request's trees and diffs """
+    if DEBUG_SAMPLE_RATE <= 0 or not logger.isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= DEBUG_SAMPLE_RATE:
+        return
+    logger.debug("student tree: %r", student_analysis)
+    logger.debug("optimal tree: %r", optimal_analysis)
+    for d in diffs:
+        logger.debug("diff: %r", d)
 
 def print_tree(tree, level=0):
-    for stmt in tree.get("children", []):
+    for stmt in tree.children:
         print_statement(stmt, level)
 
 def print_statement(stmt, level):
@@ -145,213 +506,758 @@ def print_statement(stmt, level):
             print_statement(sub_stmt, level)
         return
 
-    stmt_type = stmt.get("type")
+    stmt_type = stmt.type
 
     if stmt_type == "if" or stmt_type == "elif":
         keyword = "If" if stmt_type == "if" else "Elif"
-        condition = stmt.get("condition", "<unknown>")
-        print(f"{indent}{keyword} (condition: {condition})")
-        for child in stmt.get("children", []):
+        print(f"{indent}{keyword} (condition: {stmt.condition})")
+        for child in stmt.children:
             print_statement(child, level + 1)
 
     elif stmt_type == "else":
         print(f"{indent}Else:")
-        for child in stmt.get("children", []):
+        for child in stmt.children:
             print_statement(child, level + 1)
 
     elif stmt_type == "function_def":
-        name = stmt.get("name", "<unknown>")
-        args = stmt.get("args", "unknown>")
-        print(f"{indent}Function Def: {name}({args})")
-        for child in stmt.get("children"):
+        print(f"{indent}Function Def: {stmt.name}({stmt.args})")
+        for child in stmt.children:
             print_statement(child, level + 1)
 
     elif stmt_type == "for":
-        target = stmt.get("target", "<var>")
-        iter_ = stmt.get("iter", "<iterable>")
-        print(f"{indent}For (target: {target}, iter: {iter_})")
-        for child in stmt.get("children", []):
+        print(f"{indent}For (target: {stmt.target}, iter: {stmt.iter})")
+        for child in stmt.children:
             print_statement(child, level + 1)
 
     elif stmt_type == "while":
-        condition = stmt.get("condition", "<unknown>")
-        print(f"{indent}While (condition: {condition})")
-        for child in stmt.get("children", []):
+        print(f"{indent}While (condition: {stmt.condition})")
+        for child in stmt.children:
             print_statement(child, level + 1)
 
     elif stmt_type == "return":
-        value = stmt.get("value", "<value>")
-        print(f"{indent}Return: {value}")
+        print(f"{indent}Return: {stmt.value}")
 
     elif stmt_type == "assign":
-        target = stmt.get("target", "<target>")
-        value = stmt.get("value", "<value>")
-        print(f"{indent}Assign: {target} = {value}")
+        print(f"{indent}Assign: {stmt.target} = {stmt.value}")
 
     elif stmt_type == "call":
-        func = stmt.get("func", "<func>")
-        args = stmt.get("args", [])
-        print(f"{indent}Call: {func}({', '.join(args)})")
+        print(f"{indent}Call: {stmt.func}({', '.join(str(arg) for arg in stmt.args)})")
 
     elif stmt_type == "expr":
         print(f"{indent}Expr:")
-        print_statement(stmt.get("value", {}), level + 1)
+        print_statement(stmt.value, level + 1)
 
     else:
         print(f"{indent}{stmt_type.capitalize()}: {stmt}")
 
-def compare_ast(opt_node, stu_node, path="root"):
-    diffs = []
-
-    def add_diff(diff_type, expected, found, local_path):
-        diffs.append({
-            "path": local_path,
-            "type": diff_type,
-            "expected": expected,
-            "found": found
-        })
+def _diff(diff_type, expected, found, path):
+    return {
+        "path": path,
+        "type": diff_type,
+        "expected": expected,
+        "found": found
+    }
+
+_TAIL = object()
+
+def iter_diffs(opt_node, stu_node, path="root"):
+    """ Lazily yields the diffs between two analysis trees, in tree order.
+
+    The walk uses an explicit stack, so deeply nested submissions can't
+    overflow the interpreter's recursion limit.
+    """
+    stack = [(opt_node, stu_node, path)]
+    while stack:
+        opt_node, stu_node, path = stack.pop()
+
+        # Missing/extra children are reported after every child subtree
+        if opt_node is _TAIL:
+            yield from stu_node
+            continue
+
+        # Identical subtrees (and, at the root, identical programs) have nothing to report
+        if opt_node.hash == stu_node.hash:
+            continue
+
+        if opt_node.type != stu_node.type:
+            yield _diff("type_mismatch", opt_node.type, stu_node.type, path)
+            continue
+
+        node_type = opt_node.type
+
+        if node_type == "function_def":
+            if opt_node.name != stu_node.name:
+                yield _diff("function_name_mismatch", opt_node.name, stu_node.name, path + " > function_def")
+            if opt_node.args != stu_node.args:
+                yield _diff("function_args_mismatch", opt_node.args, stu_node.args, path + " > args")
+
+        elif node_type == "assign":
+            if opt_node.target != stu_node.target:
+                yield _diff("assign_target_mismatch", opt_node.target, stu_node.target, path + " > assign")
+            if opt_node.value != stu_node.value:
+                yield _diff("assign_value_mismatch", opt_node.value, stu_node.value, path + " > assign")
+
+        elif node_type in ["if", "elif", "while"]:
+            if opt_node.condition != stu_node.condition:
+                yield _diff("condition_mismatch", opt_node.condition, stu_node.condition, path + f" > {node_type}")
+
+        elif node_type == "for":
+            if opt_node.iter != stu_node.iter:
+                yield _diff("iter_range_mismatch", opt_node.iter, stu_node.iter, path + " > iter range")
+
+        elif node_type == "return":
+            if opt_node.value != stu_node.value:
+                yield _diff("return_value_mismatch", opt_node.value, stu_node.value, path + " > return")
+
+        elif node_type == "expr":
+            opt_val, stu_val = opt_node.value, stu_node.value
+            if opt_val.type == "call" and stu_val.type == "call":
+                if opt_val.func != stu_val.func:
+                    yield _diff("call_func_mismatch", opt_val.func, stu_val.func, path + " > call")
+                if opt_val.args != stu_val.args:
+                    yield _diff("call_args_mismatch", opt_val.args, stu_val.args, path + " > call")
+
+        # Recurse into children
+        opt_children = opt_node.children
+        stu_children = stu_node.children
+
+        # If either child is a list inside a list (like `[[{...}]]`), flatten it
+        if len(opt_children) == 1 and isinstance(opt_children[0], list):
+            opt_children = opt_children[0]
+        if len(stu_children) == 1 and isinstance(stu_children[0], list):
+            stu_children = stu_children[0]
+
+        # Handle missing or extra children
+        tail = []
+        if len(opt_children) > len(stu_children):
+            for i in range(len(stu_children), len(opt_children)):
+                tail.append(_diff("missing_child", opt_children[i], None, path + f" > {node_type}[{i}]"))
+        elif len(stu_children) > len(opt_children):
+            for i in range(len(opt_children), len(stu_children)):
+                tail.append(_diff("extra_child", None, stu_children[i], path + f" > {node_type}[{i}]"))
+        if tail:
+            stack.append((_TAIL, tail, None))
+
+        for i in reversed(range(min(len(opt_children), len(stu_children)))):
+            if opt_children[i].hash != stu_children[i].hash:
+                stack.append((opt_children[i], stu_children[i], path + f" > {node_type}[{i}]"))
 
-    # print(f'opt node: {opt_node}')
-    # print(f"stu node: {stu_node}")
+def compare_ast(opt_node, stu_node, path="root"):
+    return list(iter_diffs(opt_node, stu_node, path))
+
+@app.exception_handler(AnalysisRejected)
+async def analysis_rejected(request: Request, exc: AnalysisRejected):
+    rejections.inc(status=exc.status_code)
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+class Admission:
+    """ Counts requests queued or running in the worker pool and refuses new ones past a limit """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.pending >= self.limit:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+admission = Admission(MAX_PENDING)
+_worker_pool = None
+
+def get_worker_pool():
+    """ Process pool that does the CPU-bound analysis, sized to the machine's cores """
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = ProcessPoolExecutor(max_workers=WORKERS)
+    return _worker_pool
+
+def reset_worker_pool():
+    global _worker_pool
+    pool, _worker_pool = _worker_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def overloaded(status_code, detail):
+    rejections.inc(status=status_code)
+    return HTTPException(status_code=status_code, detail=detail,
+                         headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+@contextmanager
+def admitted():
+    """ Reserves a slot in the worker queue for the duration of the block """
+    if not admission.try_acquire():
+        raise overloaded(429, "Too many analyses in progress, try again shortly")
+    try:
+        yield get_worker_pool()
+    except BrokenProcessPool:
+        reset_worker_pool()
+        raise overloaded(503, "Analysis workers are restarting, try again shortly")
+    finally:
+        admission.release()
+
+def cached_reference(optimal_code, timings=None):
+    """ The reference's analysis from this worker's cache, and whether it was already there """
+    misses = reference_cache.misses
+    analysis = reference_cache.get(optimal_code, timings)
+    return analysis, reference_cache.misses == misses
+
+def run_reference_analysis(optimal_code):
+    """ cached_reference, run in a pool worker under a CPU time limit """
+    with cpu_time_limit(CPU_LIMIT_SECONDS):
+        return cached_reference(optimal_code)
+
+def run_comparison(optimal_code, student_code):
+    """ The /compare-code pipeline, run in a pool worker under a CPU time limit """
+    timings = {"parse": 0.0, "analyze": 0.0}
+    with cpu_time_limit(CPU_LIMIT_SECONDS):
+        student_analysis = analyze_submission(student_code, timings)
+        optimal_analysis, reference_hit = cached_reference(optimal_code, timings)
+
+        start = time.perf_counter()
+        diffs = compare_ast(optimal_analysis, student_analysis)
+        compared = time.perf_counter()
+        feedback = generate_hints(diffs)
+        timings["compare"] = compared - start
+        timings["hints"] = time.perf_counter() - compared
+
+    maybe_dump_trees(optimal_analysis, student_analysis, diffs)
+    return {
+        "feedback": feedback,
+        "timings": timings,
+        "optimal_size": optimal_analysis.size,
+        "student_size": student_analysis.size,
+        "diffs": len(diffs),
+        "reference_cache_hit": reference_hit,
+    }
 
-    if opt_node["type"] != stu_node["type"]:
-        add_diff("type_mismatch", opt_node["type"], stu_node["type"], path)
-        return diffs
+@app.post('/compare-code')
+async def compare_code(payload: Code):
+    """ Compares structural elements between student and optimal solution """
+    start = time.perf_counter()
+    check_source_size(payload.student_code)
+    check_source_size(payload.optimal_code)
+
+    with admitted() as pool:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, run_comparison, payload.optimal_code, payload.student_code)
+
+    response = JSONResponse(content=result["feedback"])
+    record_request(result["timings"], time.perf_counter() - start, result["optimal_size"], result["student_size"],
+                   result["diffs"])
+    worker_cache_lookups.inc(result="hit" if result["reference_cache_hit"] else "miss")
+    return response
+
+def run_hints(optimal_code, student_code, hint_limit):
+    """ The /compare-code/stream hints, found in a pool worker under a CPU time limit """
+    with cpu_time_limit(CPU_LIMIT_SECONDS):
+        student_analysis = analyze_submission(student_code)
+        optimal_analysis, reference_hit = cached_reference(optimal_code)
+        hints = list(iter_hints(iter_diffs(optimal_analysis, student_analysis), hint_limit))
+    return hints, reference_hit
+
+@app.post('/compare-code/stream')
+async def compare_code_stream(payload: CodeStream):
+    """ Streams hints as NDJSON, one line per hint.
+
+    The worker finding them stops comparing as soon as every hint type has
+    been found or `hint_limit` hints have been, so the rest of the tree is
+    never walked.
+    """
+    check_source_size(payload.student_code)
+    check_source_size(payload.optimal_code)
+
+    with admitted() as pool:
+        loop = asyncio.get_running_loop()
+        hints, reference_hit = await loop.run_in_executor(pool, run_hints, payload.optimal_code,
+                                                          payload.student_code, payload.hint_limit)
+    worker_cache_lookups.inc(result="hit" if reference_hit else "miss")
+
+    def stream():
+        for dtype, hint in hints:
+            yield json.dumps({"type": dtype, "hint": hint}) + "\n"
+        yield json.dumps({"done": True, "hints": len(hints)}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def grade_submission(optimal_analysis, student_code):
+    """ Runs in a pool worker; a submission that can't be analyzed yields an error entry """
+    try:
+        with cpu_time_limit(CPU_LIMIT_SECONDS):
+            student_analysis = analyze_submission(student_code)
+            diffs = compare_ast(optimal_analysis, student_analysis)
+            return {"feedback": generate_hints(diffs)}
+    except AnalysisRejected as e:
+        return {"error": e.detail}
+
+@app.post('/compare-code/batch')
+def compare_code_batch(payload: CodeBatch):
+    """ Grades many submissions against one reference, analyzing the reference once """
+    check_source_size(payload.optimal_code)
+
+    with admitted() as pool:
+        optimal_analysis, reference_hit = pool.submit(run_reference_analysis, payload.optimal_code).result()
+        worker_cache_lookups.inc(result="hit" if reference_hit else "miss")
+        chunksize = max(1, len(payload.student_codes) // (WORKERS * 4))
+        grade = partial(grade_submission, optimal_analysis)
+
+        results = []
+        for i, result in enumerate(pool.map(grade, payload.student_codes, chunksize=chunksize)):
+            results.append({"index": i, **result})
+
+    return JSONResponse(content={"results": results})
+
+_verdict_cache = None
+
+def get_verdict_cache():
+    """ The worker's connection to the shared verdict cache file """
+    global _verdict_cache
+    if _verdict_cache is None:
+        _verdict_cache = VerdictCache(VERDICT_CACHE_PATH, VERDICT_CACHE_MAX_BYTES)
+    return _verdict_cache
+
+_solver_portfolio = None
+
+def get_solver_portfolio():
+    """ The worker's solver portfolio, or None when racing strategies is disabled """
+    global _solver_portfolio
+    if _solver_portfolio is None and SOLVER_PORTFOLIO:
+        _solver_portfolio = SolverPortfolio(SOLVER_PORTFOLIO)
+    return _solver_portfolio
+
+_sandbox_pool = None
+
+def get_sandbox_pool():
+    """ The worker's pool of memory-limited processes that run submitted code """
+    global _sandbox_pool
+    # A submission from an earlier check can still get a sandbox process killed for its CPU use
+    if _sandbox_pool is not None and getattr(_sandbox_pool, "_broken", False):
+        reset_sandbox_pool()
+    if _sandbox_pool is None:
+        _sandbox_pool = ProcessPoolExecutor(max_workers=SANDBOX_WORKERS, initializer=limit_worker_memory,
+                                            initargs=(SANDBOX_MEMORY_BYTES,))
+        # A pool worker exits through multiprocessing's exit handler, which skips atexit hooks
+        # but waits for the worker's children. So the sandbox is stopped first, ahead of the
+        # handler closing the queues it needs to stop
+        multiprocessing.util.Finalize(None, _stop_sandbox_pool, args=(os.getpid(),), exitpriority=100)
+    return _sandbox_pool
+
+def _stop_sandbox_pool(owner):
+    # The sandbox processes inherit the exit handler, but not the pool
+    if owner == os.getpid() and _sandbox_pool is not None:
+        _sandbox_pool.shutdown(wait=True, cancel_futures=True)
+
+def reset_sandbox_pool():
+    global _sandbox_pool
+    pool, _sandbox_pool = _sandbox_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def run_equivalence(optimal_code, student_code, variables, timeout_ms, theory="auto", deadline=None):
+    """ The /compare-code/equivalence check, run in a pool worker under a CPU time limit.
+
+    deadline is a time.time() value, so it means the same in every process.
+    """
+    # A batch left running by an earlier check can get the sandbox killed under this one, so a
+    # broken sandbox is only blamed on the submission if it breaks again
+    for attempt in range(2):
+        deadline_s = None
+        if deadline is not None:
+            deadline_s = deadline - time.time()
+            if deadline_s <= 0:
+                raise AnalysisRejected(503, "Equivalence check timed out waiting for a worker")
+        try:
+            with cpu_time_limit(EQUIVALENCE_CPU_LIMIT_SECONDS):
+                return check_equivalence(optimal_code, student_code, variables, timeout_ms, deadline_s=deadline_s,
+                                         cache=get_verdict_cache(), theory=theory,
+                                         portfolio=get_solver_portfolio(), sandbox=get_sandbox_pool())
+        except SandboxOverrun:
+            reset_sandbox_pool()
+            raise AnalysisRejected(422, "Submission kept running past its time limit")
+        except BrokenProcessPool:
+            reset_sandbox_pool()
+            if attempt:
+                raise AnalysisRejected(422, "Submission crashed the process running it")
+        except SyntaxError as e:
+            raise AnalysisRejected(400, f"SyntaxError: {e}")
+        except (NotImplementedError, ValueError) as e:
+            raise AnalysisRejected(422, f"Unsupported code: {e}")
+
+@app.post('/compare-code/equivalence')
+async def compare_code_equivalence(payload: EquivalenceCheck):
+    """ Checks with Z3 that the student function returns what the optimal one does on every input """
+    check_source_size(payload.student_code)
+    check_source_size(payload.optimal_code)
+    timeout_ms = min(payload.timeout_ms or EQUIVALENCE_TIMEOUT_MS, EQUIVALENCE_TIMEOUT_MS)
+    deadline = time.time() + EQUIVALENCE_DEADLINE_SECONDS
+
+    with admitted() as pool:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, run_equivalence, payload.optimal_code, payload.student_code,
+                                            payload.variables, timeout_ms, payload.theory, deadline)
+
+    equivalence_checks.inc(verdict=result["verdict"])
+    verdict_cache_lookups.inc(result="hit" if result["cached"] else "miss")
+    for strategy, wins in result.get("strategy_wins", {}).items():
+        solver_strategy_wins.inc(wins, strategy=strategy)
+    equivalence_latency.observe(result["timings"]["total"])
+    return JSONResponse(content=result)
+
+@app.get('/metrics')
+def metrics():
+    """ Prometheus scrape endpoint """
+    body = render_metrics(
+        stage_latency, request_latency, tree_size, diff_count, rejections, worker_cache_lookups,
+        equivalence_checks, equivalence_latency, verdict_cache_lookups, solver_strategy_wins,
+        Gauge("code_parser_pending_analyses", "Requests queued or running in the worker pool",
+              lambda: admission.pending),
+        Gauge("code_parser_sessions", "Open incremental analysis sessions", lambda: len(sessions)),
+    )
+    return PlainTextResponse(body, media_type=CONTENT_TYPE)
+
+@app.get('/compare-code/cache')
+def compare_code_cache():
+    """ Hit/miss counters for the reference solution cache.
+
+    References are only analyzed in the pool workers, each with a cache of
+    its own; these are the totals of the lookups they report back. Their
+    sizes and evictions stay in the workers and aren't included.
+    """
+    hits = worker_cache_lookups.value(result="hit")
+    misses = worker_cache_lookups.value(result="miss")
+    return {
+        "max_entries": reference_cache.max_entries,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+    }
+
+def _stmt_span(stmt, offset=0):
+    start = min([stmt.lineno] + [d.lineno for d in getattr(stmt, "decorator_list", [])])
+    return (start + offset, stmt.end_lineno + offset)
+
+def analyze_statements(source, line_offset=0):
+    """ (spans, nodes) of source's top-level statements, run in a pool worker under a CPU time limit """
+    with cpu_time_limit(CPU_LIMIT_SECONDS):
+        tree = ast.parse(source)
+        check_depth(tree, MAX_AST_DEPTH)
+        analyzer = CodeAnalyzer()
+        try:
+            nodes = [analyzer.visit(stmt) for stmt in tree.body]
+        except (RecursionError, MemoryError):
+            raise AnalysisRejected(422, "Source is too deeply nested to analyze")
+    return [_stmt_span(stmt, line_offset) for stmt in tree.body], nodes
+
+def statement_diffs(pairs):
+    """ compare_ast of each (reference, submission, path) pair, run in a pool worker under a CPU time limit """
+    with cpu_time_limit(CPU_LIMIT_SECONDS):
+        return [compare_ast(opt, stu, path) for opt, stu, path in pairs]
+
+class AnalysisSession:
+    """ Live-editor session that only re-analyzes the top-level statements an edit touches.
+
+    The session's state lives here, but parsing, analysis and comparison
+    run in `pool` (the request's slot in the worker pool) when it is set.
+    """
+
+    def __init__(self, optimal_analysis):
+        self.optimal_analysis = optimal_analysis
+        self.pool = None
+        self.lock = threading.Lock()
+        self.lines = []
+        self.spans = []   # (start_line, end_line) of each top-level statement
+        self.nodes = []   # analyzed Node of each top-level statement
+        self._diff_cache = {}
+        self.last_reanalyzed = 0
+
+    def _run(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+        return self.pool.submit(func, *args).result()
+
+    def _reparse_all(self, lines):
+        check_source_size("".join(lines))
+        # Keep the text even if it doesn't parse, so later edits line up with the client's
+        self.lines = lines
+        self.spans = None
+        spans, nodes = self._run(analyze_statements, "".join(lines))
+        self.spans, self.nodes = spans, nodes
+        self.last_reanalyzed = len(nodes)
+
+    def submit_code(self, code):
+        """ Accepts the whole program and turns it into the smallest line edit """
+        new_lines = code.splitlines(keepends=True)
+        old_lines = self.lines
+        if not old_lines or self.spans is None:
+            self._reparse_all(new_lines)
+            return
+
+        prefix = 0
+        limit = min(len(old_lines), len(new_lines))
+        while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < limit - prefix
+               and old_lines[len(old_lines) - 1 - suffix] == new_lines[len(new_lines) - 1 - suffix]):
+            suffix += 1
+
+        self.apply_edit(prefix + 1, len(old_lines) - suffix,
+                        "".join(new_lines[prefix:len(new_lines) - suffix]))
+
+    def apply_edit(self, start_line, end_line, text):
+        old_lines = self.lines
+        if not (1 <= start_line <= len(old_lines) + 1 and start_line - 1 <= end_line <= len(old_lines)):
+            raise ValueError(f"edit range {start_line}-{end_line} is outside the {len(old_lines)}-line program")
+
+        inserted = text.splitlines(keepends=True)
+        if inserted and not inserted[-1].endswith("\n") and end_line < len(old_lines):
+            inserted[-1] += "\n"
+        new_lines = old_lines[:start_line - 1] + inserted + old_lines[end_line:]
+        check_source_size("".join(new_lines))
+        if self.spans is None:
+            self._reparse_all(new_lines)
+            return
+
+        # Top-level statements overlapping the edited lines (or containing an insertion point)
+        touched = [i for i, (s, e) in enumerate(self.spans)
+                   if (s <= end_line and e >= start_line) or s < start_line <= e]
+        if touched:
+            first, last = touched[0], touched[-1]
+            region_start = min(start_line, self.spans[first][0])
+            region_end = max(end_line, self.spans[last][1])
+        else:
+            first = last = sum(1 for _, e in self.spans if e < start_line)
+            last -= 1
+            region_start, region_end = start_line, end_line
+
+        delta = len(inserted) - (end_line - start_line + 1)
+        region = new_lines[region_start - 1:region_end + delta]
+        try:
+            spans, nodes = self._run(analyze_statements, "".join(region), region_start - 1)
+        except SyntaxError:
+            # The edit may have merged into a neighbouring statement; start over
+            self._reparse_all(new_lines)
+            return
+
+        self.spans[first:last + 1] = spans
+        self.nodes[first:last + 1] = nodes
+        tail = first + len(nodes)
+        self.spans[tail:] = [(s + delta, e + delta) for s, e in self.spans[tail:]]
+        self.lines = new_lines
+        self.last_reanalyzed = len(nodes)
+
+    def analysis(self):
+        return Node("module", list(self.nodes))
+
+    def compare(self):
+        """ compare_ast against the reference, reusing per-statement results that haven't changed """
+        opt = self.optimal_analysis
+        stu = self.analysis()
+        if opt.hash == stu.hash:
+            self._diff_cache = {}
+            return []
+
+        opt_children, stu_children = opt.children, stu.children
+        keys = [(i, opt_children[i].hash, stu_children[i].hash)
+                for i in range(min(len(opt_children), len(stu_children)))]
+        changed = [key for key in keys if key not in self._diff_cache]
+        computed = self._run(statement_diffs, [(opt_children[i], stu_children[i], f"root > module[{i}]")
+                                               for i, _, _ in changed]) if changed else []
+
+        diff_cache = {key: self._diff_cache[key] for key in keys if key in self._diff_cache}
+        diff_cache.update(zip(changed, computed))
+        diffs = [d for key in keys for d in diff_cache[key]]
+        self._diff_cache = diff_cache
 
-    node_type = opt_node["type"]
-
-    if node_type == "function_def":
-        if opt_node["name"] != stu_node["name"]:
-            add_diff("function_name_mismatch", opt_node["name"], stu_node["name"], path + " > function_def")
-        if opt_node.get("args") != stu_node.get("args"):
-            add_diff("function_args_mismatch", opt_node.get("args"), stu_node.get("args"), path + " > args")
-
-    elif node_type == "assign":
-        if opt_node["target"] != stu_node["target"]:
-            add_diff("assign_target_mismatch", opt_node["target"], stu_node["target"], path + " > assign")
-        if opt_node["value"] != stu_node["value"]:
-            add_diff("assign_value_mismatch", opt_node["value"], stu_node["value"], path + " > assign")
-
-    elif node_type in ["if", "elif", "while"]:
-        if opt_node.get("condition") != stu_node.get("condition"):
-            add_diff("condition_mismatch", opt_node.get("condition"), stu_node.get("condition"), path + f" > {node_type}")
-
-    elif node_type == "for":
-        if opt_node.get("iter") != stu_node.get("iter"):
-            add_diff("iter_range_mismatch", opt_node.get("iter"), stu_node.get("iter"), path + " > iter range")
-
-    elif node_type == "return":
-        if opt_node.get("value") != stu_node.get("value"):
-            add_diff("return_value_mismatch", opt_node.get("value"), stu_node.get("value"), path + " > return")
-
-    elif node_type == "expr":
-        opt_val, stu_val = opt_node["value"], stu_node["value"]
-        if opt_val["type"] == "call" and stu_val["type"] == "call":
-            if opt_val["func"] != stu_val["func"]:
-                add_diff("call_func_mismatch", opt_val["func"], stu_val["func"], path + " > call")
-            if opt_val["args"] != stu_val["args"]:
-                add_diff("call_args_mismatch", opt_val["args"], stu_val["args"], path + " > call")
-
-    # Recurse into children
-    opt_children = opt_node.get("children", [])
-    stu_children = stu_node.get("children", [])
-
-    # If either child is a list inside a list (like `[[{...}]]`), flatten it
-    if len(opt_children) == 1 and isinstance(opt_children[0], list):
-        opt_children = opt_children[0]
-    if len(stu_children) == 1 and isinstance(stu_children[0], list):
-        stu_children = stu_children[0]
-
-    min_len = min(len(opt_children), len(stu_children))
-    for i in range(min_len):
-        # print(f"\nComparing path: {path + f' > {node_type}[{i}]'}")
-        # print(f"opt_children[{i}]: {opt_children[i]}")
-        # print(f"stu_children[{i}]: {stu_children[i]}")
-        # print(f"opt_children[{i}] type: {type(opt_children[i])}")
-        # print(f"stu_children[{i}] type: {type(stu_children[i])}")
-
-        diffs += compare_ast(opt_children[i], stu_children[i], path + f" > {node_type}[{i}]")
-
-    # Handle missing or extra children
-    if len(opt_children) > len(stu_children):
         for i in range(len(stu_children), len(opt_children)):
-            add_diff("missing_child", opt_children[i], None, path + f" > {node_type}[{i}]")
-    elif len(stu_children) > len(opt_children):
+            diffs.append({"path": f"root > module[{i}]", "type": "missing_child",
+                          "expected": opt_children[i], "found": None})
         for i in range(len(opt_children), len(stu_children)):
-            add_diff("extra_child", None, stu_children[i], path + f" > {node_type}[{i}]")
+            diffs.append({"path": f"root > module[{i}]", "type": "extra_child",
+                          "expected": None, "found": stu_children[i]})
+        return diffs
 
-    return diffs
+MAX_SESSIONS = 1024
+sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def get_session(session_id):
+    with _sessions_lock:
+        session = sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired session")
+        sessions.move_to_end(session_id)
+        return session
+
+@app.post('/sessions')
+def open_session(payload: SessionStart):
+    """ Opens an incremental hint session for one problem's reference solution """
+    check_source_size(payload.optimal_code)
+    with admitted() as pool:
+        optimal_analysis, reference_hit = pool.submit(run_reference_analysis, payload.optimal_code).result()
+    worker_cache_lookups.inc(result="hit" if reference_hit else "miss")
+    session = AnalysisSession(optimal_analysis)
+    session_id = uuid.uuid4().hex
+    with _sessions_lock:
+        sessions[session_id] = session
+        while len(sessions) > MAX_SESSIONS:
+            sessions.popitem(last=False)
+    return {"session_id": session_id}
+
+@app.post('/sessions/{session_id}/submit')
+def submit_to_session(session_id: str, payload: SessionEdit):
+    """ Applies a full-text or line-range edit and returns hints for the updated program """
+    session = get_session(session_id)
+    with session.lock, admitted() as pool:
+        session.pool = pool
+        try:
+            if payload.code is not None:
+                session.submit_code(payload.code)
+            elif payload.start_line is not None and payload.text is not None:
+                end_line = payload.end_line if payload.end_line is not None else payload.start_line
+                session.apply_edit(payload.start_line, end_line, payload.text)
+            else:
+                raise HTTPException(status_code=422, detail="Send either `code` or `start_line`/`end_line`/`text`")
+            feedback = generate_hints(session.compare())
+        except (SyntaxError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            session.pool = None
+    return JSONResponse(content=feedback)
 
-@app.post('/compare-code')
-def compare_code(payload: Code):
+@app.delete('/sessions/{session_id}')
+def close_session(session_id: str):
+    with _sessions_lock:
+        sessions.pop(session_id, None)
+    return {"closed": session_id}
+
+_plagiarism_index = None
+_plagiarism_lock = threading.Lock()
+
+def get_plagiarism_index():
+    global _plagiarism_index
+    with _plagiarism_lock:
+        if _plagiarism_index is None:
+            _plagiarism_index = FingerprintIndex(PLAGIARISM_INDEX_DIR)
+        return _plagiarism_index
+
+def run_fingerprint(code, num_perm, k, window):
+    """ A submission's MinHash signature, computed in a pool worker under a CPU time limit """
+    try:
+        with cpu_time_limit(CPU_LIMIT_SECONDS):
+            return source_signature(code, num_perm, k, window)
+    except SyntaxError as e:
+        raise AnalysisRejected(400, f"SyntaxError: {e}")
+    except (RecursionError, MemoryError):
+        raise AnalysisRejected(422, "Source is too deeply nested to analyze")
+
+def submission_signature(index, code):
+    check_source_size(code)
+    with admitted() as pool:
+        return pool.submit(run_fingerprint, code, index.num_perm, index.k, index.window).result()
+
+@app.post('/plagiarism/submissions')
+def index_submission(payload: PlagiarismSubmission):
+    """ Reports the closest earlier submissions, then adds this one to the index """
+    index = get_plagiarism_index()
+    if payload.submission_id in index:
+        raise HTTPException(status_code=409, detail=f"Submission {payload.submission_id!r} is already indexed")
+    signature = submission_signature(index, payload.code)
+    similar = index.query_signature(signature, top_k=payload.top_k, exclude=payload.submission_id)
+    try:
+        index.add_signature(payload.submission_id, signature)
+    except KeyError:
+        # Indexed by a concurrent request in the meantime
+        raise HTTPException(status_code=409, detail=f"Submission {payload.submission_id!r} is already indexed")
+    return {
+        "submission_id": payload.submission_id,
+        "similar": [{"submission_id": sid, "similarity": score} for sid, score in similar],
+    }
+
+@app.post('/plagiarism/query')
+def query_plagiarism(payload: PlagiarismQuery):
+    """ Closest indexed submissions by estimated Jaccard similarity of AST fingerprints """
+    index = get_plagiarism_index()
+    similar = index.query_signature(submission_signature(index, payload.code), top_k=payload.top_k,
+                                    min_similarity=payload.min_similarity)
+    return {"similar": [{"submission_id": sid, "similarity": score} for sid, score in similar]}
+
+# Every diff type that produces a hint; once each has been emitted there is nothing left to say
+HINT_TYPES = (
+    "extra_child", "missing_child", "iter_range_mismatch", "function_name_mismatch",
+    "call_func_mismatch", "call_args_mismatch", "return_value_mismatch", "condition_mismatch",
+    "assign_target_mismatch", "assign_value_mismatch", "type_mismatch",
+)
 
-    # print("🔍 Student Code:")
-    # print(payload.student_code)
-    # print("🔍 Optimal Code:")
-    # print(payload.optimal_code)
-    
-    """ Compares structural elements between student and optimal solution """
-    
-    student_analysis = analyze_code(payload.student_code)
-    print(f"student tree: {student_analysis}")
-    optimal_analysis = analyze_code(payload.optimal_code)
-    print(f"optimal tree: {optimal_analysis}")
+def hint_for(d):
+    dtype = d['type']
 
-    print(f"student analysis: {print_tree(student_analysis)}")
-    print(f"target analysis: {print_tree(optimal_analysis)}")
+    if dtype == "extra_child":
+        return "Oh no! Seems like you've written more code than expected."
 
-    diffs = compare_ast(optimal_analysis, student_analysis)
-    for d in diffs:
-        print(d)
+    elif dtype == "missing_child":
+        return "Oh no! Seems like you've written lesser code than expected. One or more lines are missing."
 
-    generate_hints(diffs)
-    feedback = generate_hints(diffs)
-    return JSONResponse(content=feedback)
+    elif dtype == "iter_range_mismatch":
+        return f"Oops! Looks like the iter range in one of your for loops seems to be wrong. It's probably this one: {d['found']}. Why don't you work on that?"
 
-def generate_hints(diffs):
-    feedback = {}
+    elif dtype == "function_name_mismatch":
+        return f"Oops! You'd better work on your naming conventions! How could you improve the name of function {d['found']}?"
 
-    for d in diffs:
-        hint = None
-        dtype = d['type']
+    elif dtype == "call_func_mismatch":
+        return f"You haven't called the right function at {d['found']}. It should be something else..."
 
-        if dtype == "extra_child":
-            hint = "Oh no! Seems like you've written more code than expected."
+    elif dtype == "call_args_mismatch":
+        return f"You haven't passed the right arguments to your function! The wrong ones are: {d['found']}."
 
-        elif dtype == "missing_child":
-            hint = "Oh no! Seems like you've written lesser code than expected. One or more lines are missing."
+    elif dtype == "return_value_mismatch":
+        return f"Your return statement seems a little off... What's really wrong with {d['found']}?"
 
-        elif dtype == "iter_range_mismatch":
-            hint = f"Oops! Looks like the iter range in one of your for loops seems to be wrong. It's probably this one: {d['found']}. Why don't you work on that?"
+    elif dtype == "condition_mismatch":
+        return f"Oops! The conditional statement in your code is causing issues with test cases! How could you improve {d['found']}?"
 
-        elif dtype == "function_name_mismatch":
-            hint = f"Oops! You'd better work on your naming conventions! How could you improve the name of function {d['found']}?"
+    elif dtype == "assign_target_mismatch":
+        return f"You haven't assigned your value to the right variable. What should {d['found']} really be assigned to?"
 
-        elif dtype == "call_func_mismatch":
-            hint = f"You haven't called the right function at {d['found']}. It should be something else..."
+    elif dtype == "assign_value_mismatch":
+        return f"You haven't assigned the right value to your variable. What should {d['found']} really be?"
 
-        elif dtype == "call_args_mismatch":
-            hint = f"You haven't passed the right arguments to your function! The wrong ones are: {d['found']}."
+    elif dtype == "type_mismatch":
+        return f"You've accidentally used {d['found']} instead of what should be used."
 
-        elif dtype == "return_value_mismatch":
-            hint = f"Your return statement seems a little off... What's really wrong with {d['found']}?"
+    return None
 
-        elif dtype == "condition_mismatch":
-            hint = f"Oops! The conditional statement in your code is causing issues with test cases! How could you improve {d['found']}?"
+def iter_hints(diffs, limit=None):
+    """ Yields (type, hint) for the first diff of each type, pulling no more diffs than needed """
+    if limit is not None and limit <= 0:
+        return
 
-        elif dtype == "assign_target_mismatch":
-            hint = f"You haven't assigned your value to the right variable. What should {d['found']} really be assigned to?"
-        
-        elif dtype == "assign_value_mismatch":
-            hint = f"You haven't assigned the right value to your variable. What should {d['found']} really be?"
-        
-        elif dtype == "type_mismatch":
-            hint = f"You've accidentally used {d['found']} instead of what should be used."
+    seen = set()
+    for d in diffs:
+        dtype = d['type']
+        # Only the first hint per type is kept, so don't format (and unparse) the rest
+        if dtype in seen:
+            continue
 
-        if hint and dtype not in feedback:
-            feedback[dtype] = hint
+        hint = hint_for(d)
+        if not hint:
+            continue
 
-    print("Generated Feedback:", feedback)
+        seen.add(dtype)
+        yield dtype, hint
+        if len(seen) == len(HINT_TYPES) or (limit is not None and len(seen) >= limit):
+            return
+
+def generate_hints(diffs):
+    feedback = dict(iter_hints(diffs))
+    logger.debug("Generated feedback: %s", feedback)
     return feedback
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import hashlib
+
+import chromadb
+from chromadb.config import Settings
+
+
+def context_text(item):
+    """ The text embedded for a context item: its string fields joined in order """
+    return " | ".join(str(value) for value in item.values() if isinstance(value, str))
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def open_collection(path, name, embedder_name):
+    """ A collection in a persistent Chroma store at path.
+
+    The embedder's name is kept in the collection's metadata; if it doesn't
+    match (the model was changed) the stored vectors can't be compared with
+    new queries, so the collection is dropped and rebuilt from scratch.
+    """
+    client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+    collection = client.get_or_create_collection(name, metadata={"embedder": embedder_name})
+    if (collection.metadata or {}).get("embedder") != embedder_name:
+        client.delete_collection(name)
+        collection = client.create_collection(name, metadata={"embedder": embedder_name})
+    return client, collection
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def sync_collection(collection, embed, items, batch_size=256):
+    """ Brings the collection in line with items, embedding only what it doesn't have yet.
+
+    Documents are keyed by the hash of their text, so an unchanged item is
+    a set lookup, an edited one is a new id (and its old id is removed),
+    and identical items are stored once. embed takes a list of texts and
+    returns a list of vectors, one per text. Returns counts of added,
+    removed and unchanged documents, and the index version: a hash of
+    all ids, so it changes whenever any document does.
+    """
+    wanted = {}
+    for item in items:
+        text = context_text(item)
+        wanted.setdefault(content_hash(text), text)
+
+    existing = set(collection.get(include=[])["ids"])
+    stale = [key for key in existing if key not in wanted]
+    missing = [key for key in wanted if key not in existing]
+
+    for ids in _chunks(stale, batch_size):
+        collection.delete(ids=ids)
+    for ids in _chunks(missing, batch_size):
+        documents = [wanted[key] for key in ids]
+        collection.upsert(ids=ids, documents=documents, embeddings=embed(documents))
+
+    return {"added": len(missing), "removed": len(stale), "unchanged": len(wanted) - len(missing),
+            "version": content_hash("\n".join(sorted(wanted)))}
@@ -0,0 +1,338 @@
+import ast
+import builtins
+import math
+import resource
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import numpy as np
+
+# Builtins visible to submitted code. This only keeps honest mistakes from
+# touching the file system; the worker process and its limits are the
+# actual sandbox.
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in (
+    "abs", "all", "any", "bool", "chr", "dict", "divmod", "enumerate", "filter", "float", "int",
+    "isinstance", "len", "list", "map", "max", "min", "ord", "pow", "range", "reversed", "round",
+    "set", "sorted", "str", "sum", "tuple", "zip", "ArithmeticError", "Exception", "IndexError",
+    "KeyError", "TypeError", "ValueError", "ZeroDivisionError",
+)}
+SAFE_BUILTINS["print"] = lambda *args, **kwargs: None
+
+# Values where off-by-one and overflow-style bugs tend to show up
+INT_BOUNDARIES = (0, 1, -1, 2, -2, 3, 7, 10, -10, 100, -100, 255, 256, 1000, 2 ** 31 - 1, -2 ** 31, 2 ** 63)
+
+WORKER_MEMORY_BYTES = 1024 * 1024 * 1024
+
+# CPU a sandboxed batch may use past its deadline before the kernel kills it,
+# and how long a batch may run past it before its pool's processes are killed
+SANDBOX_CPU_SLACK_S = 1.0
+SANDBOX_GRACE_S = 2.0
+
+
+# Not an Exception, so `except Exception` in a submission doesn't swallow it
+class CallTimeout(BaseException):
+    pass
+
+
+class SandboxOverrun(BrokenProcessPool):
+    """ A batch ran past its deadline, so the pool's processes were killed; the pool has to be replaced """
+
+
+def check_function(source):
+    """ Raises SyntaxError or ValueError unless source compiles and defines a function; runs none of it """
+    tree = ast.parse(source)
+    if not any(isinstance(node, ast.FunctionDef) for node in tree.body):
+        raise ValueError("Expected the code to define a function")
+    compile(tree, "<submission>", "exec")
+
+
+def compile_function(source):
+    """ The first function defined in source, compiled once with the restricted builtins """
+    tree = ast.parse(source)
+    funcs = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+    if not funcs:
+        raise ValueError("Expected the code to define a function")
+    namespace = {"__builtins__": SAFE_BUILTINS}
+    exec(compile(tree, "<submission>", "exec"), namespace)
+    return namespace[funcs[0].name]
+
+
+def param_kinds(source):
+    """ "int", "list" or "str" per parameter of the first function, guessed from how it is used """
+    func = next(node for node in ast.parse(source).body if isinstance(node, ast.FunctionDef))
+    kinds = {arg.arg: "int" for arg in func.args.args}
+    for node in ast.walk(func):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "len" \
+                and node.args and isinstance(node.args[0], ast.Name) and node.args[0].id in kinds:
+            kinds[node.args[0].id] = "list"
+        elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id in kinds:
+            kinds[node.value.id] = "list"
+        elif isinstance(node, ast.For) and isinstance(node.iter, ast.Name) and node.iter.id in kinds:
+            kinds[node.iter.id] = "list"
+        elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in kinds \
+                and hasattr(str, node.attr) and not hasattr(list, node.attr):
+            kinds[node.value.id] = "str"
+    return [kinds[arg.arg] for arg in func.args.args]
+
+
+def generate_inputs(kinds, count, seed=0, seeds=()):
+    """ Argument tuples: the given seeds first, then boundary values, then random samples.
+
+    Random columns are drawn with NumPy a whole batch at a time, from a
+    narrow range where most branches are decided and from a wide log-scale
+    range for overflow-style bugs.
+    """
+    rng = np.random.default_rng(seed)
+    inputs = [tuple(args) for args in seeds]
+
+    def boundary_column(kind, i):
+        if kind == "int":
+            return INT_BOUNDARIES[i % len(INT_BOUNDARIES)]
+        if kind == "str":
+            return ("", "a", "ab", "aba", "Hello World", "  ")[i % 6]
+        return ([], [0], [1, 2], [2, 1], [-1, 0, 1], [5, 5, 5])[i % 6]
+
+    # Every parameter walks the boundary values, shifted so the combinations differ
+    n_boundary = len(INT_BOUNDARIES) * max(1, len(kinds))
+    inputs += [tuple(boundary_column(kind, i + j * 3) for j, kind in enumerate(kinds)) for i in range(n_boundary)]
+
+    remaining = max(0, count - len(inputs))
+    if remaining:
+        columns = []
+        for kind in kinds:
+            if kind == "int":
+                narrow = rng.integers(-50, 51, size=remaining)
+                wide = np.sign(rng.standard_normal(remaining)) * np.floor(10 ** rng.uniform(0, 12, size=remaining))
+                columns.append(np.where(rng.random(remaining) < 0.7, narrow, wide.astype(np.int64)).tolist())
+            elif kind == "list":
+                lengths = rng.integers(0, 9, size=remaining)
+                values = rng.integers(-20, 21, size=(remaining, 8))
+                columns.append([row[:n].tolist() for row, n in zip(values, lengths)])
+            else:
+                lengths = rng.integers(0, 9, size=remaining)
+                letters = rng.integers(ord("a"), ord("e") + 1, size=(remaining, 8))
+                columns.append(["".join(map(chr, row[:n])) for row, n in zip(letters, lengths)])
+        inputs += list(zip(*columns)) if columns else [()] * remaining
+    return inputs[:count]
+
+
+def _on_timeout(signum, frame):
+    raise CallTimeout()
+
+
+def _outer_limit_running():
+    return signal.getitimer(signal.ITIMER_PROF)[0] > 0
+
+
+def call_with_limit(func, args, limit_s):
+    """ ("ok", value) or ("raised", exception name); ("timeout", None) past limit_s of CPU.
+
+    An outer ITIMER_PROF limit (see code_parser.cpu_time_limit) that runs
+    out during the call ends the whole check, so whatever its handler
+    raises is passed on rather than blamed on the function. The timeout is
+    an exception raised inside func, which a bare except can still catch;
+    in a sandbox, run_batch's RLIMIT_CPU is what actually stops it.
+    """
+    # ITIMER_VIRTUAL so the outer ITIMER_PROF limit keeps running
+    main_thread = threading.current_thread() is threading.main_thread()
+    limited = limit_s and main_thread
+    outer_limit = main_thread and _outer_limit_running()
+    if limited:
+        previous = signal.signal(signal.SIGVTALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_VIRTUAL, limit_s)
+    try:
+        outcome = "ok", func(*[list(arg) if isinstance(arg, list) else arg for arg in args])
+    except CallTimeout:
+        outcome = "timeout", None
+    except RecursionError:
+        outcome = "raised", "RecursionError"
+    except Exception as e:
+        if outer_limit and not _outer_limit_running():
+            raise
+        outcome = "raised", type(e).__name__
+    finally:
+        if limited:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            signal.signal(signal.SIGVTALRM, previous)
+    if outer_limit and not _outer_limit_running():
+        # The function caught what the handler raised; raise it again out here
+        signal.raise_signal(signal.SIGPROF)
+    return outcome
+
+
+def _same(expected, actual):
+    if expected[0] != actual[0]:
+        return False
+    if expected[0] == "ok" and isinstance(expected[1], float) and isinstance(actual[1], float):
+        return expected[1] == actual[1] or (math.isnan(expected[1]) and math.isnan(actual[1]))
+    try:
+        return bool(expected[1] == actual[1])
+    except Exception:
+        return repr(expected[1]) == repr(actual[1])
+
+
+def jsonable(outcome):
+    status, value = outcome
+    if status == "raised":
+        return {"raised": value}
+    if status == "timeout":
+        return {"timeout": True}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [jsonable(("ok", v)) for v in value]
+    return repr(value)
+
+
+_compiled = {}
+
+
+def _compiled_function(source):
+    func = _compiled.get(source)
+    if func is None:
+        if len(_compiled) > 64:
+            _compiled.clear()
+        func = _compiled[source] = compile_function(source)
+    return func
+
+
+@contextmanager
+def process_cpu_limit(seconds):
+    """ Has the kernel kill this process (SIGXCPU) once it uses `seconds` more CPU in the block """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    limit = math.ceil(usage.ru_utime + usage.ru_stime + seconds)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def run_batch(target_src, user_src, inputs, limit_s, deadline=None, sandboxed=False):
+    """ (inputs tried, first disagreement or None); runs in a pool worker or in-process.
+
+    Inputs the reference itself rejects with a TypeError or can't finish in
+    time aren't valid for the exercise and are skipped. sandboxed (with a
+    deadline) also puts an RLIMIT_CPU on the process, including loading
+    the submissions, so code that swallows CallTimeout or loops at module
+    level is killed; only pass it in a worker that may die.
+    """
+    if sandboxed and deadline is not None:
+        with process_cpu_limit(max(0.0, deadline - time.monotonic()) + SANDBOX_CPU_SLACK_S):
+            return run_batch(target_src, user_src, inputs, limit_s, deadline)
+
+    target = _compiled_function(target_src)
+    user = _compiled_function(user_src)
+    tried = 0
+    for args in inputs:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        expected = call_with_limit(target, args, limit_s)
+        if expected[0] == "timeout" or expected == ("raised", "TypeError"):
+            continue
+        tried += 1
+        actual = call_with_limit(user, args, limit_s)
+        if not _same(expected, actual):
+            return tried, (args, jsonable(expected), jsonable(actual))
+    return tried, None
+
+
+def _kill_workers(pool):
+    # ProcessPoolExecutor has no public way to stop a running task
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.kill()
+
+
+def limit_worker_memory(max_bytes=WORKER_MEMORY_BYTES):
+    """ Pool initializer: caps the worker's address space so runaway submissions fail with MemoryError.
+
+    Also turns off core dumps, which the SIGXCPU from run_batch's CPU limit
+    would otherwise write.
+    """
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    except (ValueError, OSError):
+        pass
+
+
+def differential_check(target_src, user_src, seeds=(), count=2000, batch_size=250, call_limit_s=0.05,
+                       budget_s=2.0, deadline=None, pool=None, seed=0):
+    """ Runs both functions on generated inputs and reports the first disagreement.
+
+    seeds are argument tuples tried first, e.g. from Z3 models of the
+    reference's feasible paths. With a pool (ideally one created with
+    limit_worker_memory as initializer) the batches are spread over its
+    workers and outstanding ones are cancelled once a disagreement is
+    found. Testing stops after budget_s seconds or at deadline (a
+    time.monotonic() value), whichever is first. Returns (inputs tried,
+    counterexample or None).
+
+    With a pool the submissions are only ever loaded and run in its
+    workers. Those run under an RLIMIT_CPU, and if a batch is still running
+    SANDBOX_GRACE_S past the deadline the pool's processes are killed and
+    SandboxOverrun is raised; either way the pool is broken and its owner
+    has to replace it.
+    """
+    # Both must compile before any input is tried; nothing in them runs in this process
+    check_function(target_src)
+    check_function(user_src)
+    names = [arg.arg for arg in next(node for node in ast.parse(target_src).body
+                                     if isinstance(node, ast.FunctionDef)).args.args]
+
+    stop = time.monotonic() + budget_s
+    deadline = stop if deadline is None else min(deadline, stop)
+    inputs = generate_inputs(param_kinds(target_src), count, seed, seeds)
+    batches = [inputs[i:i + batch_size] for i in range(0, len(inputs), batch_size)]
+    found = None
+    tried = 0
+
+    if pool is None:
+        for batch in batches:
+            n, found = run_batch(target_src, user_src, batch, call_limit_s, deadline)
+            tried += n
+            if found is not None:
+                break
+    else:
+        futures = [pool.submit(run_batch, target_src, user_src, batch, call_limit_s, deadline, True)
+                   for batch in batches]
+        pending = set(futures)
+        overran = False
+        try:
+            while pending and found is None:
+                done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()) + call_limit_s,
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    overran = True
+                    break
+                for future in sorted(done, key=futures.index):
+                    n, disagreement = future.result()
+                    tried += n
+                    if disagreement is not None and found is None:
+                        found = disagreement
+        finally:
+            if not overran:
+                for future in pending:
+                    future.cancel()
+
+        if overran:
+            # Batches check the deadline between inputs, so one still running well past it is stuck.
+            # Nothing is cancelled first: a pool that breaks with cancelled futures queued fails on them
+            if wait(pending, timeout=SANDBOX_GRACE_S).not_done:
+                _kill_workers(pool)
+                raise SandboxOverrun("Submitted code kept running past its time limit")
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in pending):
+                # Killed by its RLIMIT_CPU in the meantime
+                raise SandboxOverrun("Submitted code kept running past its time limit")
+
+    if found is None:
+        return tried, None
+    args, expected, actual = found
+    return tried, {"inputs": dict(zip(names, args)), "expected": expected, "actual": actual}
@@ -1,15 +1,24 @@
 from z3 import *
 import ast
 import copy
+import hashlib
+import json
+import multiprocessing
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import TimeoutError as FuturesTimeout, as_completed
+from contextlib import contextmanager, nullcontext
+from multiprocessing.connection import wait as wait_connections
+
+from differential_testing import differential_check
 
 ast_z3_map = {
     ast.Add: lambda a, b: a + b,
     ast.Sub: lambda a, b: a - b,
     ast.Mult: lambda a, b: a * b,
-    ast.Div: lambda a, b: a / b,
-    ast.Mod: lambda a, b: a % b,
     ast.Pow: lambda a, b: a ** b,
-    ast.FloorDiv: lambda a, b: a / b,
 
     ast.BitAnd: lambda a, b: a & b,
     ast.BitOr: lambda a, b: a | b,
@@ -28,56 +37,175 @@ ast_z3_map = {
     ast.Or: lambda a, b: Or(a, b),
 }
 
+BITWISE_OPS = (ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift, ast.Invert)
+
+def _real(value):
+    return ToReal(value) if is_int(value) else value
+
+class IntTheory:
+    """ Python ints as unbounded Z3 Ints.
+
+    Z3's div and mod are Euclidean, so floor division and modulo are
+    rebuilt with Python's semantics (the remainder takes the divisor's
+    sign). True division goes through Real.
+    """
+
+    name = "int"
+
+    def var(self, name):
+        return Int(name)
+
+    def const(self, value):
+        return IntVal(value)
+
+    def mod(self, a, b):
+        if is_real(a) or is_real(b):
+            return REAL_THEORY.mod(_real(a), _real(b))
+        return If(b > 0, a % b, -((-a) % (-b)))
+
+    def floordiv(self, a, b):
+        if is_real(a) or is_real(b):
+            return REAL_THEORY.floordiv(a, b)
+        # Exact once the Python remainder is taken off
+        return (a - self.mod(a, b)) / b
+
+    def truediv(self, a, b):
+        return _real(a) / _real(b)
+
+class RealTheory(IntTheory):
+    """ Inputs as Reals. Z3's reals are exact where Python's floats round,
+    and a counterexample may need a fractional input. """
+
+    name = "real"
+
+    def var(self, name):
+        return Real(name)
+
+    def const(self, value):
+        return RealVal(value)
+
+    def floordiv(self, a, b):
+        return ToReal(ToInt(_real(a) / _real(b)))
+
+    def mod(self, a, b):
+        return a - b * self.floordiv(a, b)
+
+class BitVecTheory(IntTheory):
+    """ Python ints as fixed-width signed bit-vectors.
+
+    Bitwise operators and shifts are native and nonlinear arithmetic is
+    decided by bit-blasting, but results only hold modulo 2**width:
+    counterexamples may rely on overflow. z3's % on bit-vectors is bvsmod,
+    which already has Python's sign convention.
+    """
+
+    def __init__(self, width=32):
+        self.width = width
+        self.name = f"bitvec{width}"
+
+    def var(self, name):
+        return BitVec(name, self.width)
+
+    def const(self, value):
+        return BitVecVal(value, self.width)
+
+    def mod(self, a, b):
+        return a % b
+
+    def floordiv(self, a, b):
+        return (a - a % b) / b
+
+    def truediv(self, a, b):
+        raise NotImplementedError("True division isn't supported on bit-vectors")
 
-def ast_to_z3(node, variables):
+INT_THEORY = IntTheory()
+REAL_THEORY = RealTheory()
+BITVEC_THEORY = BitVecTheory()
+
+def choose_theory(*funcs):
+    """ The theory for the functions' inputs: BitVec if they use bitwise operators, which
+    Int can't express, Int otherwise. Int inputs stay integers when the code uses floats
+    or true division; those parts of the computation go through Real. """
+    ops = {type(node.op) for func in funcs for node in ast.walk(func) if isinstance(node, (ast.BinOp, ast.UnaryOp))}
+    if ops.intersection(BITWISE_OPS):
+        return BITVEC_THEORY
+    return INT_THEORY
+
+def _is_exact(theory, *funcs):
+    """ Whether the theory's verdicts hold for Python on every input: only Int, and only
+    without floats or true division, whose results Python rounds """
+    if theory is not INT_THEORY:
+        return False
+    return not any(isinstance(node, ast.Div) or isinstance(node, ast.Constant) and isinstance(node.value, float)
+                   for func in funcs for node in ast.walk(func))
+
+
+def ast_to_z3(node, variables, theory=INT_THEORY):
     if isinstance(node, ast.Tuple):
-        return tuple(ast_to_z3(elt, variables) for elt in node.elts)
+        return tuple(ast_to_z3(elt, variables, theory) for elt in node.elts)
 
     elif isinstance(node, ast.BinOp):
-        left = ast_to_z3(node.left, variables)
-        right = ast_to_z3(node.right, variables)
-        return ast_z3_map[type(node.op)](left, right)
+        left = ast_to_z3(node.left, variables, theory)
+        right = ast_to_z3(node.right, variables, theory)
+        if isinstance(node.op, ast.FloorDiv):
+            return theory.floordiv(left, right)
+        if isinstance(node.op, ast.Mod):
+            return theory.mod(left, right)
+        if isinstance(node.op, ast.Div):
+            return theory.truediv(left, right)
+        try:
+            return ast_z3_map[type(node.op)](left, right)
+        except (TypeError, Z3Exception):
+            raise NotImplementedError(f"{type(node.op).__name__} isn't supported in the {theory.name} encoding")
     
     elif isinstance(node, ast.Subscript):
-        arr = ast_to_z3(node.value, variables)
-        index = ast_to_z3(node.slice, variables)
+        arr = ast_to_z3(node.value, variables, theory)
+        index = ast_to_z3(node.slice, variables, theory)
         return Select(arr, index)  # Z3's way to access array elements
 
 
     elif isinstance(node, ast.Compare):
-        left = ast_to_z3(node.left, variables)
-        right = ast_to_z3(node.comparators[0], variables)
-        return ast_z3_map[type(node.ops[0])](left, right)
+        # a < b < c is a < b and b < c
+        operands = [ast_to_z3(operand, variables, theory) for operand in [node.left] + node.comparators]
+        for op in node.ops:
+            if type(op) not in ast_z3_map:
+                raise NotImplementedError(f"Unsupported comparison operator: {type(op)}")
+        comparisons = [ast_z3_map[type(op)](left, right)
+                       for op, left, right in zip(node.ops, operands, operands[1:])]
+        return comparisons[0] if len(comparisons) == 1 else And(*comparisons)
 
     elif isinstance(node, ast.Name):
+        if node.id not in variables:
+            raise ValueError(f"Unbound variable: {node.id}")
         return variables[node.id]
 
     elif isinstance(node, ast.Constant):
         val = node.value
-        if isinstance(val, int):
-            return IntVal(val)
+        if isinstance(val, bool):
+            return BoolVal(val)
+        elif isinstance(val, int):
+            return theory.const(val)
         elif isinstance(val, float):
             return RealVal(val)
-        elif isinstance(val, bool):
-            return BoolVal(val)
         elif isinstance(val, str):
             return StringVal(val)
         else:
             raise NotImplementedError(f"Unsupported constant type: {type(val)}")
 
     elif isinstance(node, ast.BoolOp):
-        left = ast_to_z3(node.values[0], variables)
-        right = ast_to_z3(node.values[1], variables)
-        return ast_z3_map[type(node.op)](left, right)
+        values = [ast_to_z3(value, variables, theory) for value in node.values]
+        return And(*values) if isinstance(node.op, ast.And) else Or(*values)
     
     elif isinstance(node, ast.UnaryOp):
-        operand = ast_to_z3(node.operand, variables)
+        operand = ast_to_z3(node.operand, variables, theory)
         if isinstance(node.op, ast.USub):      # e.g., -1
             return -operand
         elif isinstance(node.op, ast.UAdd):    # e.g., +1 (rare)
             return operand
         elif isinstance(node.op, ast.Not):     # e.g., not x
             return Not(operand)
+        elif isinstance(node.op, ast.Invert) and is_bv(operand):
+            return ~operand
         else:
             raise NotImplementedError(f"Unsupported unary operator: {type(node.op)}")
 
@@ -86,7 +214,6 @@ def ast_to_z3(node, variables):
         if isinstance(node.func, ast.Name) and node.func.id == 'len':
             arg = node.args[0]
             var_name = f"{arg.id}_len"
-            print(f"arg: {arg}, var: {var_name}")
             if var_name in variables:
                 return variables[var_name]
             else:
@@ -97,175 +224,1097 @@ def ast_to_z3(node, variables):
     else:
         raise NotImplementedError(f"Unsupported AST node: {ast.dump(node)}")
 
-def symbolic_execute(statements, memory, path_condition, all_paths):
-    for stmt in statements:
-        if isinstance(stmt, ast.Assign):
-            target = stmt.targets[0]
+_DELETED = object()
+
+class SymbolicStore(MutableMapping):
+    """ Copy-on-write variable bindings for symbolic execution.
+
+    fork() is O(1): the bindings written so far are frozen into a layer that
+    both stores share, and each side then writes into its own fresh layer.
+    Z3 expressions are immutable, so sharing them between paths is safe and
+    only reassigned variables ever get a new binding.
+    """
+    __slots__ = ("_local", "_layers")
+
+    # Lookups walk the layers, so collapse them once a chain gets this long
+    MAX_LAYERS = 16
+
+    def __init__(self, bindings=None):
+        self._local = dict(bindings or {})
+        self._layers = ()
+
+    def __getitem__(self, key):
+        if key in self._local:
+            value = self._local[key]
+        else:
+            value = _DELETED
+            for layer in self._layers:
+                if key in layer:
+                    value = layer[key]
+                    break
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+    def __delitem__(self, key):
+        self[key]  # raises KeyError if unbound
+        self._local[key] = _DELETED
+
+    def _flatten(self):
+        merged = {}
+        for layer in reversed(self._layers):
+            merged.update(layer)
+        merged.update(self._local)
+        return {k: v for k, v in merged.items() if v is not _DELETED}
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def fork(self):
+        if self._local:
+            self._layers = (self._local,) + self._layers
+            self._local = {}
+        if len(self._layers) > self.MAX_LAYERS:
+            self._layers = (self._flatten(),)
+
+        child = SymbolicStore.__new__(SymbolicStore)
+        child._local = {}
+        child._layers = self._layers
+        return child
+
+def fork_memory(memory):
+    """ Independent copy of a path's memory; O(1) for a SymbolicStore """
+    if isinstance(memory, SymbolicStore):
+        return memory.fork()
+    return copy.deepcopy(memory)
+
+class FeasibilityChecker:
+    """ Incremental solver whose assertion stack mirrors the path being explored.
+
+    Branch conditions are pushed on entry and popped on exit, so a check only
+    adds one condition to what Z3 already knows about the path. Results are
+    cached per (path, condition), and a branch whose sibling is unsat is
+    known to be feasible without asking the solver.
+    """
+
+    def __init__(self, timeout_ms=None):
+        self.solver = Solver()
+        if timeout_ms:
+            self.solver.set("timeout", timeout_ms)
+        self._path = []
+        self._cache = {}
+        self.checks = 0
+        self.cache_hits = 0
+        self.pruned = 0
+        self.solver_time = 0.0
+
+    def feasible(self, cond):
+        key = (tuple(c.get_id() for c in self._path), cond.get_id())
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached[0]
+
+        self.checks += 1
+        start = time.perf_counter()
+        self.solver.push()
+        self.solver.add(cond)
+        # unknown (e.g. a timeout) keeps the path rather than risk dropping a real one
+        result = self.solver.check() != unsat
+        self.solver.pop()
+        self.solver_time += time.perf_counter() - start
+
+        # Holding the expressions keeps Z3 from recycling their ids
+        self._cache[key] = (result, tuple(self._path), cond)
+        return result
+
+    def branch(self, cond):
+        """ (then feasible, else feasible) for a condition on the current path """
+        folded = simplify(cond)
+        if is_true(folded):
+            result = (True, False)
+        elif is_false(folded):
+            result = (False, True)
+        elif not self.feasible(folded):
+            # The current path is feasible, so if one side is unsat the other can't be
+            result = (False, True)
+        else:
+            result = (True, self.feasible(Not(folded)))
+        self.pruned += result.count(False)
+        return result
+
+    @contextmanager
+    def assume(self, cond):
+        self.solver.push()
+        self.solver.add(cond)
+        self._path.append(cond)
+        try:
+            yield
+        finally:
+            self._path.pop()
+            self.solver.pop()
+
+    def stats(self):
+        return {"solver_checks": self.checks, "cache_hits": self.cache_hits,
+                "pruned_branches": self.pruned, "solver_time": self.solver_time}
+
+TRUE = BoolVal(True)
+
+def _and(a, b):
+    if is_true(a):
+        return b
+    if is_true(b):
+        return a
+    return And(a, b)
+
+def _same(a, b):
+    if isinstance(a, ExprRef) and isinstance(b, ExprRef):
+        return a.eq(b)
+    return a is b
+
+def _branching_after(stmts):
+    """ For each statement, whether any later statement in the block can fork a path """
+    result = []
+    seen = False
+    for stmt in reversed(stmts):
+        result.append(seen)
+        seen = seen or any(isinstance(node, (ast.If, ast.While, ast.For)) for node in ast.walk(stmt))
+    return result[::-1]
+
+def _returns_none(stmt):
+    return stmt.value is None or isinstance(stmt.value, ast.Constant) and stmt.value.value is None
+
+class SymbolicExecution:
+    """ Explores a function body, recording a path at every return.
+
+    Execution works on states (memory, path condition, guard). The guard is
+    the part of the path condition added since the enclosing block was
+    entered, and it is what the feasibility solver has to be told when the
+    state is resumed. Statements that split a state (if, loops) return every
+    state still live after them, and those states carry on through the rest
+    of the block.
+
+    At join points (after an if, and at each loop iteration boundary) the
+    live states can be merged into one whose variables are If(guard, a, b)
+    terms. merge="never" always forks, "always" merges whenever the states
+    are compatible, and "auto" merges when few variables differ and the
+    merged state still has branching code ahead of it, where forking would
+    multiply paths.
+    """
+
+    # Symbolic loop conditions are unrolled this many times before paths are dropped
+    MAX_WHILE_UNROLL = 3
+    MAX_FOR_UNROLL = 5
+    # Iterations whose condition simplifies to a constant don't count towards
+    # the unroll limits, up to this cap
+    MAX_CONCRETE_ITERATIONS = 256
+    # merge="auto" only merges states that differ in at most this many variables
+    MERGE_MAX_DIFF = 4
+
+    def __init__(self, all_paths, feasibility=None, merge="never", theory=INT_THEORY):
+        if merge not in ("never", "auto", "always"):
+            raise ValueError(f"Unknown merge mode: {merge}")
+        self.all_paths = all_paths
+        self.theory = theory
+        self.feasibility = feasibility
+        self.merge = merge
+        self.merges = 0
+        # States still inside a loop at its unroll limit
+        self.truncated = []
+
+    def branch(self, cond):
+        if self.feasibility is not None:
+            return self.feasibility.branch(cond)
+        folded = simplify(cond)
+        return not is_false(folded), not is_true(folded)
+
+    def assume(self, cond):
+        if self.feasibility is None or is_true(cond):
+            return nullcontext()
+        return self.feasibility.assume(cond)
+
+    # --- joins ---
+
+    def join(self, states, entry_pc, branching_ahead):
+        if self.merge == "never" or len(states) < 2:
+            return states
+        if self.merge == "auto" and not branching_ahead:
+            return states
+        merged = self._merge(states, entry_pc)
+        if merged is None:
+            return states
+        self.merges += 1
+        return [merged]
+
+    def _merge(self, states, entry_pc):
+        keys = []
+        for memory, _, _ in states:
+            keys.extend(k for k in memory if k not in keys)
+
+        bindings = {}
+        differing = 0
+        for key in keys:
+            if any(key not in memory for memory, _, _ in states):
+                return None
+            present = [(memory[key], guard) for memory, _, guard in states]
+            first = present[0][0]
+            if all(_same(value, first) for value, _ in present[1:]):
+                bindings[key] = first
+                continue
+
+            if not all(isinstance(value, ExprRef) for value, _ in present):
+                return None
+            if any(not value.sort().eq(first.sort()) for value, _ in present[1:]):
+                return None
+            differing += 1
+            if self.merge == "auto" and differing > self.MERGE_MAX_DIFF:
+                return None
+
+            value = present[-1][0]
+            for other, guard in reversed(present[:-1]):
+                value = If(guard, other, value)
+            bindings[key] = value
+
+        guard = simplify(Or(*[guard for _, _, guard in states]))
+        return SymbolicStore(bindings), _and(entry_pc, guard), guard
+
+    # --- statements ---
+
+    def run_block(self, stmts, states):
+        for stmt, branching_ahead in zip(stmts, _branching_after(stmts)):
+            next_states = []
+            for memory, pc, guard in states:
+                with self.assume(guard):
+                    for memory2, pc2, guard2 in self.execute(stmt, memory, pc, branching_ahead):
+                        next_states.append((memory2, pc2, _and(guard, guard2)))
+            states = next_states
+            if not states:
+                break
+        return states
+
+    def execute(self, stmt, memory, pc, branching_ahead):
+        """ Live states after one statement; their guards are relative to the state passed in """
+        if isinstance(stmt, (ast.Assign, ast.AnnAssign)) and getattr(stmt, "value", None) is not None:
+            targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+            if len(targets) != 1:
+                raise NotImplementedError("Chained assignment isn't supported")
+            target = targets[0]
 
             if isinstance(target, ast.Name):
-                var = target.id
-                value = ast_to_z3(stmt.value, memory)
-                memory[var] = value
+                memory[target.id] = ast_to_z3(stmt.value, memory, self.theory)
 
-            elif isinstance(target, ast.Tuple):
+            elif isinstance(target, ast.Tuple) and all(isinstance(elt, ast.Name) for elt in target.elts):
                 # Unpack values from RHS tuple
-                values = ast_to_z3(stmt.value, memory)
+                values = ast_to_z3(stmt.value, memory, self.theory)
                 if not isinstance(values, tuple) or len(values) != len(target.elts):
                     raise ValueError("Tuple unpacking mismatch")
 
                 for elt, val in zip(target.elts, values):
-                    if isinstance(elt, ast.Name):
-                        memory[elt.id] = val
+                    memory[elt.id] = val
 
-        elif isinstance(stmt, ast.If):
-            cond = ast_to_z3(stmt.test, memory)
-
-            # Then branch
-            then_mem = copy.deepcopy(memory)
-            then_pc = And(path_condition, cond)
-            symbolic_execute(stmt.body, then_mem, then_pc, all_paths)
+            else:
+                raise NotImplementedError(f"Unsupported assignment target: {ast.dump(target)}")
+            return [(memory, pc, TRUE)]
 
-            # Else branch
-            else_mem = copy.deepcopy(memory)
-            else_pc = And(path_condition, Not(cond))
-            symbolic_execute(stmt.orelse, else_mem, else_pc, all_paths)
+        elif isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name):
+            value = ast_to_z3(ast.BinOp(ast.Name(stmt.target.id, ast.Load()), stmt.op, stmt.value), memory,
+                              self.theory)
+            memory[stmt.target.id] = value
+            return [(memory, pc, TRUE)]
 
         elif isinstance(stmt, ast.Return):
-            return_expr = ast_to_z3(stmt.value, memory)
-            all_paths.append({
-                "pc": path_condition,
-                "ret": return_expr,
+            self.all_paths.append({
+                "pc": pc,
+                # A bare return, like falling off the end, returns None
+                "ret": None if _returns_none(stmt) else ast_to_z3(stmt.value, memory, self.theory),
                 "from": ast.dump(stmt),
                 "context": list(memory.items())
             })
+            return []
 
+        elif isinstance(stmt, ast.If):
+            cond = ast_to_z3(stmt.test, memory, self.theory)
+            then_ok, else_ok = self.branch(cond)
+            live = []
+            for taken, side, body in ((then_ok, cond, stmt.body), (else_ok, Not(cond), stmt.orelse)):
+                if not taken:
+                    continue
+                side_memory = fork_memory(memory) if then_ok and else_ok else memory
+                with self.assume(side):
+                    for memory2, pc2, guard2 in self.run_block(body, [(side_memory, _and(pc, side), TRUE)]):
+                        live.append((memory2, pc2, _and(side, guard2)))
+            return self.join(live, pc, branching_ahead)
 
         elif isinstance(stmt, ast.While):
-            cond = ast_to_z3(stmt.test, memory)
-
-            # Limit how deep we unroll
-            max_unroll = 3
-
-            def unroll_loop(mem, pc, depth):
-                if depth > max_unroll:
-                    return
-                cond_eval = ast_to_z3(stmt.test, mem)
-                
-                # Loop body taken
-                loop_body_mem = copy.deepcopy(mem)
-                loop_body_pc = And(pc, cond_eval)
-                symbolic_execute(stmt.body, loop_body_mem, loop_body_pc, all_paths)
-                unroll_loop(loop_body_mem, loop_body_pc, depth + 1)
-
-                # Exit condition
-                after_loop_mem = copy.deepcopy(mem)
-                after_loop_pc = And(pc, Not(cond_eval))
-                symbolic_execute(stmt.orelse or [], after_loop_mem, after_loop_pc, all_paths)
-
-            unroll_loop(memory, path_condition, 1)
+            return self._loop(stmt, memory, pc, self.MAX_WHILE_UNROLL,
+                              lambda mem, i: ast_to_z3(stmt.test, mem, self.theory), None)
 
         elif isinstance(stmt, ast.For):
-            if not (isinstance(stmt.iter, ast.Call) and 
-                    isinstance(stmt.iter.func, ast.Name) and 
+            if not isinstance(stmt.target, ast.Name):
+                raise NotImplementedError("Only loops over a single name are supported")
+            if not (isinstance(stmt.iter, ast.Call) and
+                    isinstance(stmt.iter.func, ast.Name) and
                     stmt.iter.func.id == 'range'):
                 raise NotImplementedError("Only simple `range()` loops are supported")
 
             range_args = stmt.iter.args
             if len(range_args) == 1:
-                start, end = 0, ast_to_z3(range_args[0], memory)
+                start, end = self.theory.const(0), ast_to_z3(range_args[0], memory, self.theory)
             elif len(range_args) == 2:
-                start, end = ast_to_z3(range_args[0], memory), ast_to_z3(range_args[1], memory)
+                start, end = ast_to_z3(range_args[0], memory, self.theory), ast_to_z3(range_args[1], memory, self.theory)
             else:
                 raise NotImplementedError("range(start, stop, step) not yet supported")
 
-            max_unroll = 5  # Prevent infinite expansion
-            for_val = stmt.target.id
-
-            for i in range(max_unroll):
+            def iteration_value(i):
                 if isinstance(start, IntNumRef):
-                    iter_i = IntVal(start.as_long() + i)
-                else:
-                    start = IntVal(start) if isinstance(start, int) else start
-                    iter_i = simplify(start + i)
+                    return IntVal(start.as_long() + i)
+                return simplify(start + i)
+
+            def set_target(mem, i):
+                mem[stmt.target.id] = iteration_value(i)
+
+            return self._loop(stmt, memory, pc, self.MAX_FOR_UNROLL,
+                              lambda mem, i: simplify(iteration_value(i) < end), set_target)
+
+        elif isinstance(stmt, ast.Pass) or isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant):
+            # pass and docstrings are the only statements that can't change the result
+            return [(memory, pc, TRUE)]
+
+        # raise, assert, break, try, with, del, calls for their side effects, ... aren't modelled
+        raise NotImplementedError(f"Unsupported statement: {type(stmt).__name__}")
+
+    def _loop(self, stmt, memory, pc, max_unroll, condition, on_enter):
+        """ Unrolls a loop; condition(mem, i) is the test before iteration i """
+        live = [(memory, pc, TRUE)]
+        exits = []
+        symbolic_iterations = 0
+
+        for i in range(self.MAX_CONCRETE_ITERATIONS):
+            if not live:
+                break
+            if symbolic_iterations >= max_unroll:
+                break
+
+            next_live = []
+            forked = False
+            for mem, path_pc, guard in live:
+                with self.assume(guard):
+                    cond = condition(mem, i)
+                    body_ok, exit_ok = self.branch(cond)
+                    forked = forked or (body_ok and exit_ok)
+                    if exit_ok:
+                        exit_mem = fork_memory(mem) if body_ok else mem
+                        exits.append((exit_mem, _and(path_pc, Not(cond)), _and(guard, Not(cond))))
+                    if body_ok:
+                        if on_enter is not None:
+                            on_enter(mem, i)
+                        with self.assume(cond):
+                            for mem2, pc2, guard2 in self.run_block(stmt.body, [(mem, _and(path_pc, cond), TRUE)]):
+                                next_live.append((mem2, pc2, _and(guard, _and(cond, guard2))))
+
+            if forked:
+                symbolic_iterations += 1
+            live = self.join(next_live, pc, True)
 
-                iter_cond = simplify(iter_i < end)
-                if isinstance(iter_cond, bool) and not iter_cond:
-                    break   
-                loop_mem = copy.deepcopy(memory)
-                loop_mem[for_val] = iter_i
-                symbolic_execute(stmt.body, loop_mem, iter_cond, all_paths)
+        # Paths still inside the loop at the unroll limit aren't explored further
+        self.truncated.extend(live)
 
-            # After loop finishes
-            after_mem = copy.deepcopy(memory)
-            symbolic_execute(stmt.orelse or [], after_mem, path_condition, all_paths)
+        exits = self.join(exits, pc, True)
+        if stmt.orelse:
+            after = []
+            for mem, path_pc, guard in exits:
+                with self.assume(guard):
+                    for mem2, pc2, guard2 in self.run_block(stmt.orelse, [(mem, path_pc, TRUE)]):
+                        after.append((mem2, pc2, _and(guard, guard2)))
+            exits = after
+        return exits
 
+    def stats(self):
+        stats = {"paths": sum(not path.get("truncated") for path in self.all_paths), "merges": self.merges,
+                 "truncated_paths": len(self.truncated)}
+        if self.feasibility is not None:
+            stats.update(self.feasibility.stats())
+        return stats
 
-def extract_paths_from_code(code_str):
+def symbolic_execute(statements, memory, path_condition, all_paths, feasibility=None, merge="never",
+                     theory=INT_THEORY):
+    """ Records a path in all_paths for each return reachable from statements.
+
+    Returns the (memory, path condition) states that fall off the end.
+    """
+    execution = SymbolicExecution(all_paths, feasibility, merge, theory)
+    live = execution.run_block(statements, [(memory, path_condition, TRUE)])
+    return [(mem, pc) for mem, pc, _ in live]
+
+def function_def(code_str):
+    """ The first top-level function in code_str """
     tree = ast.parse(code_str)
-    func = tree.body[0]
-    
-    memory = {
-        'a': Int('a'),
-        'b': Int('b'),
-        'i': Int('i')
-    }
+    if not tree.body or not isinstance(tree.body[0], ast.FunctionDef):
+        raise ValueError("Expected the code to start with a function definition")
+    return tree.body[0]
+
+def input_memory(func, variables=None, theory=INT_THEORY):
+    """ Initial store for func: a symbolic input per variable name, or func's parameters by default.
+
+    variables may also map names to Z3 expressions, e.g. to bind another
+    function's parameters to the same symbols by position.
+    """
+    if variables is None:
+        variables = [arg.arg for arg in func.args.args]
+    if isinstance(variables, dict):
+        return SymbolicStore(variables)
+    return SymbolicStore({name: theory.var(name) for name in variables})
+
+def extract_paths_from_code(code_str, prune=True, merge="never", stats=None, variables=None, timeout_ms=None,
+                            theory=None):
+    """ Symbolic paths of the first function in code_str.
+
+    Every input lies on one of them: a path ends at a return or by falling
+    off the end of the function (both with "ret" None when nothing is
+    returned), or is marked "truncated" where a loop hit its unroll limit.
+    prune drops infeasible branches; merge picks the join-point merging mode
+    (see SymbolicExecution). stats, if given, is filled with path counts,
+    merges and solver time. variables defaults to the function's parameters,
+    and theory to the one choose_theory picks for the function.
+    """
+    func = function_def(code_str)
+    if theory is None:
+        theory = choose_theory(func)
+    memory = input_memory(func, variables, theory)
     path_condition = BoolVal(True)
     all_paths = []
+    feasibility = FeasibilityChecker(timeout_ms) if prune else None
 
-    symbolic_execute(func.body, memory, path_condition, all_paths)
+    execution = SymbolicExecution(all_paths, feasibility, merge, theory)
+    for mem, pc, _ in execution.run_block(func.body, [(memory, path_condition, TRUE)]):
+        all_paths.append({"pc": pc, "ret": None, "from": "end of function", "context": list(mem.items())})
+    for mem, pc, _ in execution.truncated:
+        all_paths.append({"pc": pc, "ret": None, "from": "loop unroll limit", "context": list(mem.items()),
+                          "truncated": True})
+    if stats is not None:
+        stats.update(execution.stats())
     return all_paths
 
-paths1 = extract_paths_from_code(target_py_function)
-arr1 = list() # containing all pcs and returns from target function
-print("target code paths")
-for path in paths1:
-    pc = path["pc"]
-    ret = path["ret"]
-    # Optionally:
-    origin = path.get("from")
-    context = path.get("context")
-    arr1.append((pc, ret))
-    # print("IF:", pc)
-    # print("RETURNS:", ret)
-
-arr2 = list() # containing all pcs and returns from test function
-paths2 = extract_paths_from_code(test_py_function)
-print("user code paths: ")
-for path in paths2:
-    pc = path["pc"]
-    ret = path["ret"]
-    # Optionally:
-    origin = path.get("from")
-    context = path.get("context")
-    arr2.append((pc, ret))
-    # print("IF: ", pc)
-    # print("RETURNS: ", ret)
-    
-solver = z3.Solver()
-print("Comparing test function paths to golden paths...")
-any_bug = False
-
-for t_pc, t_ret in arr1:
-    solver.push()
-    # Try to find any input satisfying t_pc where ALL user paths give wrong return
-    disjunctions = []
-    for u_pc, u_ret in arr2:
-        # For each user path: if the path condition holds under t_pc,
-        # check if the return is not equal to expected
-        disjunctions.append(And(u_pc, u_ret != t_ret))
-    
-    # Now say: t_pc ∧ (∀ user paths, u_ret != t_ret)
-    solver.add(t_pc, Or(*disjunctions))
-    
-    if solver.check() == z3.sat:
-        print(f"Bug: For inputs satisfying condition: {t_pc}")
-        print(f"    Expected return: {t_ret}")
-        print(f"    But all user paths give wrong result.")
-        print("    Example input:", solver.model())
-        any_bug = True
-    solver.pop()
+# Not + (it also concatenates strings and lists) or and/or, where the first
+# operand can guard the second: swapping those changes what the code does
+COMMUTATIVE_OPS = (ast.Mult, ast.BitAnd, ast.BitOr, ast.BitXor)
+
+class _Canonicalizer(ast.NodeTransformer):
+    """ Renames variables and puts the operands of commutative operators in a fixed order """
+
+    def __init__(self, renames):
+        self.renames = renames
+
+    def visit_Name(self, node):
+        node.id = self.renames.get(node.id, node.id)
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, COMMUTATIVE_OPS):
+            node.left, node.right = sorted((node.left, node.right), key=ast.dump)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1 and isinstance(node.ops[0], (ast.Eq, ast.NotEq)):
+            node.left, node.comparators[0] = sorted((node.left, node.comparators[0]), key=ast.dump)
+        return node
+
+def canonical_function(code_str, keep=None):
+    """ Hash of the first function in code_str, invariant under renaming and reformatting.
+
+    Parameters not in keep are renamed by position and locals not in keep
+    by first assignment; keep defaults to the parameters themselves. The
+    function name, annotations and docstring are dropped, and operands of
+    commutative operators are sorted, so two functions with the same hash
+    get the same verdict from check_equivalence.
+    """
+    func = function_def(code_str)
+    params = [arg.arg for arg in func.args.args]
+    keep = set(params if keep is None else keep)
+
+    renames = {name: f"_p{i}" for i, name in enumerate(params) if name not in keep}
+    for node in ast.walk(func):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            if node.id not in keep and node.id not in renames:
+                renames[node.id] = f"_v{len(renames)}"
+
+    body = func.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        body = body[1:]
+    args = [renames.get(name, name) for name in params]
+    canonical = [_Canonicalizer(renames).visit(stmt) for stmt in body]
+    dump = repr(args) + "".join(ast.dump(stmt) for stmt in canonical)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+class PathSetCache:
+    """ Bounded LRU of reference path sets, keyed by canonical function and inputs.
+
+    Every student working on a problem is checked against the same
+    reference, so its symbolic execution is only done once per process.
+    Cached paths are shared and must never be mutated.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code_str, inputs, timeout_ms=None, theory=INT_THEORY):
+        """ (paths, stats) of extract_paths_from_code for code_str over the given input symbols """
+        key = (canonical_function(code_str, keep=inputs), tuple(inputs), theory.name)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            paths, stats = entry
+            return paths, {**stats, "solver_checks": 0, "solver_time": 0.0}
+
+        self.misses += 1
+        stats = {}
+        paths = extract_paths_from_code(code_str, stats=stats, variables=inputs, timeout_ms=timeout_ms,
+                                        theory=theory)
+        self._entries[key] = (paths, stats)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return paths, stats
+
+reference_paths = PathSetCache()
+
+def _as_number(value, like):
+    """ A bool as 1 or 0 in the sort of `like` """
+    if not is_bool(value):
+        return value
+    if is_bv(like):
+        return If(value, BitVecVal(1, like.size()), BitVecVal(0, like.size()))
+    return If(value, IntVal(1), IntVal(0))
+
+def returns_differ(expected, actual):
+    """ Condition under which two return values differ; True and 1 are equal, as in Python.
+
+    None (nothing returned) only equals None.
+    """
+    if expected is None or actual is None:
+        return BoolVal(expected is not actual)
+    if isinstance(expected, tuple) or isinstance(actual, tuple):
+        if not (isinstance(expected, tuple) and isinstance(actual, tuple)) or len(expected) != len(actual):
+            return BoolVal(True)
+        return Or(*[returns_differ(e, a) for e, a in zip(expected, actual)]) if expected else BoolVal(False)
+
+    if is_bool(expected) != is_bool(actual):
+        expected, actual = _as_number(expected, actual), _as_number(actual, expected)
+    if is_arith(expected) and is_arith(actual) or expected.sort().eq(actual.sort()):
+        return expected != actual
+    return BoolVal(True)
+
+def to_python(value):
+    """ Plain Python value for a model value, for JSON responses """
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        return [to_python(v) for v in value]
+    if is_int_value(value):
+        return value.as_long()
+    if is_bv_value(value):
+        return value.as_signed_long()
+    if is_rational_value(value):
+        return float(value.as_fraction())
+    if is_true(value) or is_false(value):
+        return is_true(value)
+    if is_string_value(value):
+        return value.as_string()
+    return str(value)
+
+def _z3_value(symbol, value):
+    if is_bool(symbol):
+        return BoolVal(value)
+    if is_bv(symbol):
+        return BitVecVal(value, symbol.size())
+    if is_real(symbol):
+        return RealVal(value)
+    return IntVal(value)
+
+def _substitute(expr, bindings):
+    if expr is None:
+        return None
+    if isinstance(expr, tuple):
+        return tuple(_substitute(e, bindings) for e in expr)
+    return simplify(substitute(expr, *bindings)) if bindings else simplify(expr)
+
+def model_values(model):
+    """ Constants assigned by a model, as plain Python values keyed by name """
+    return {decl.name(): to_python(model[decl]) for decl in model.decls() if decl.arity() == 0}
+
+def _counterexample(inputs, values, target, user_paths):
+    """ Inputs and the two return values for a model of a differing target path """
+    values = {name: values.get(name, 0) for name in inputs}
+    bindings = [(symbol, _z3_value(symbol, values[name])) for name, symbol in inputs.items()]
+    actual = next((user["ret"] for user in user_paths
+                   if not user.get("truncated") and is_true(_substitute(user["pc"], bindings))), None)
+    return {
+        "inputs": values,
+        "expected": to_python(_substitute(target["ret"], bindings)),
+        "actual": to_python(_substitute(actual, bindings)),
+    }
+
+def path_query(target, user_paths):
+    """ Satisfiable iff some input on the target path isn't on a user path returning the same value.
+
+    user_paths must cover every input (see extract_paths_from_code). An
+    input on a truncated user path counts as matching: what it returns is
+    unknown, and the truncation already makes the verdict at best unknown.
+    """
+    matching = [user["pc"] if user.get("truncated")
+                else And(user["pc"], Not(returns_differ(target["ret"], user["ret"])))
+                for user in user_paths]
+    return And(target["pc"], Not(Or(*matching)) if matching else BoolVal(True))
+
+# Solver timeout for queries sent to other processes when neither a timeout
+# nor a deadline is given: waiting on them doesn't count towards this
+# process's CPU time, so a CPU limit wouldn't stop it
+DEFAULT_REMOTE_TIMEOUT_MS = 60000
+
+def _budget_ms(timeout_ms, deadline):
+    """ Per-query solver timeout, shortened to what is left before the deadline """
+    if deadline is None:
+        return timeout_ms
+    remaining = max(1, int((deadline - time.monotonic()) * 1000))
+    return min(timeout_ms, remaining) if timeout_ms else remaining
+
+def solve_queries_serially(queries, timeout_ms=None, deadline=None, portfolio=None):
+    """ (index of the first sat query or None, its model values, any query undecided)
+
+    With a SolverPortfolio each query is raced across its strategies instead.
+    """
+    solver = Solver()
+    undecided = False
+    for index, query in enumerate(queries):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None, None, True
+        if portfolio is not None:
+            result, values = portfolio.solve(query, timeout_ms, deadline)
+            if result == "sat":
+                return index, values, undecided
+            undecided = undecided or result == "unknown"
+            continue
+        budget = _budget_ms(timeout_ms, deadline)
+        if budget:
+            solver.set("timeout", budget)
+        solver.push()
+        solver.add(query)
+        result = solver.check()
+        if result == sat:
+            return index, model_values(solver.model()), undecided
+        undecided = undecided or result == unknown
+        solver.pop()
+    return None, None, undecided
+
+def make_solver(tactics=()):
+    """ Solver running a tactic pipeline such as ("simplify", "smt"), or the default solver """
+    if not tactics:
+        return Solver()
+    return (Then(*tactics) if len(tactics) > 1 else Tactic(tactics[0])).solver()
+
+def solve_smt2(smt2, timeout_ms=None, tactics=()):
+    """ Pool worker: checks one query serialized as SMT-LIB in this process's own Z3 context """
+    solver = make_solver(tactics)
+    if timeout_ms:
+        solver.set("timeout", timeout_ms)
+    solver.from_string(smt2)
+    result = solver.check()
+    return str(result), model_values(solver.model()) if result == sat else None
+
+def solve_queries_in_pool(queries, pool, timeout_ms=None, deadline=None):
+    """ solve_queries_serially, with the queries checked concurrently in pool.
+
+    Z3 terms can't cross process boundaries, so each query is sent as
+    SMT-LIB text. Queries not yet started are cancelled as soon as one is
+    sat or the deadline passes.
+    """
+    futures = {}
+    for index, query in enumerate(queries):
+        solver = Solver()
+        solver.add(query)
+        budget = _budget_ms(timeout_ms, deadline) or DEFAULT_REMOTE_TIMEOUT_MS
+        futures[pool.submit(solve_smt2, solver.to_smt2(), budget)] = index
+
+    undecided = False
+    found = None
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            result, values = future.result()
+            if result == "sat":
+                found = (futures[future], values)
+                break
+            undecided = undecided or result == "unknown"
+    except FuturesTimeout:
+        undecided = True
+    finally:
+        for future in futures:
+            future.cancel()
 
+    if found is None:
+        return None, None, undecided
+    return found[0], found[1], undecided
+
+# Part of every verdict cache key. Bump it whenever a change to the executor,
+# the encodings or the canonicalizer could change a verdict, so verdicts
+# stored by the old code are no longer served.
+ENGINE_VERSION = 2
+
+def verdict_key(target_src, user_src, variables=None, theory="auto"):
+    """ Verdict cache key: the engine version, the canonical functions, the input names and the theory """
+    if variables is None:
+        # The target's parameter names show up in counterexamples; the user's are bound by position
+        target = canonical_function(target_src)
+        user = canonical_function(user_src, keep=())
+    else:
+        target = canonical_function(target_src, keep=variables)
+        user = canonical_function(user_src, keep=variables)
+    return hashlib.sha256(json.dumps([ENGINE_VERSION, target, user, variables, theory]).encode("utf-8")).hexdigest()
+
+THEORIES = {"int": INT_THEORY, "real": REAL_THEORY, "bitvec": BITVEC_THEORY}
+
+def _check_in_theory(target_src, user_src, target_func, user_func, variables, theory, timeout_ms, pool, deadline,
+                     portfolio):
+    start = time.perf_counter()
+    if variables is None:
+        inputs = {arg.arg: theory.var(arg.arg) for arg in target_func.args.args}
+        user_inputs = dict(zip((arg.arg for arg in user_func.args.args), inputs.values()))
+    else:
+        inputs = {name: theory.var(name) for name in variables}
+        user_inputs = inputs
+
+    target_paths, target_stats = reference_paths.get(target_src, inputs, timeout_ms, theory)
+    explored_target = time.perf_counter()
+    user_stats = {}
+    user_paths = extract_paths_from_code(user_src, stats=user_stats, variables=user_inputs, timeout_ms=timeout_ms,
+                                         theory=theory)
+    explored_user = time.perf_counter()
+
+    # Truncated target paths have no known return value to compare
+    target_paths = [path for path in target_paths if not path.get("truncated")]
+    queries = [path_query(target, user_paths) for target in target_paths]
+    if pool is not None and len(queries) > 1:
+        index, values, undecided = solve_queries_in_pool(queries, pool, timeout_ms, deadline)
+    else:
+        index, values, undecided = solve_queries_serially(queries, timeout_ms, deadline, portfolio)
+    solved = time.perf_counter()
+
+    truncated = target_stats["truncated_paths"] + user_stats["truncated_paths"]
+    counterexample = None
+    if index is not None:
+        counterexample = _counterexample(inputs, values, target_paths[index], user_paths)
+        verdict, reason = "different", None
+    elif undecided:
+        verdict, reason = "unknown", "solver timeout"
+    elif truncated:
+        verdict, reason = "unknown", "loops were only partially unrolled"
+    else:
+        verdict, reason = "equivalent", None
+
+    result = {
+        "verdict": verdict,
+        "reason": reason,
+        "counterexample": counterexample,
+        "method": "symbolic",
+        "theory": theory.name,
+        "paths": {"target": len(target_paths), "user": user_stats["paths"], "truncated": truncated},
+        "solver_checks": target_stats["solver_checks"] + user_stats["solver_checks"] + len(queries),
+        "solver_time": target_stats["solver_time"] + user_stats["solver_time"] + solved - explored_user,
+    }
+    timings = {
+        "target_paths": explored_target - start,
+        "user_paths": explored_user - explored_target,
+        "solve": solved - explored_user,
+    }
+    return result, undecided, timings
+
+# Tactic pipelines for SolverPortfolio. A pipeline that can't decide a
+# query answers unknown, e.g. nla2bv reports its unsat as unknown because
+# it only searched bounded bit-widths.
+STRATEGIES = {
+    "smt": (),
+    "simplify-smt": ("simplify", "solve-eqs", "smt"),
+    # qfnia preprocesses and hands nonlinear integer arithmetic to nlsat
+    "nlsat": ("simplify", "qfnia"),
+    "bitblast": ("simplify", "nla2bv", "smt"),
+}
+DEFAULT_PORTFOLIO = ("simplify-smt", "nlsat", "bitblast")
+
+def _portfolio_worker(tactics, conn):
+    while True:
+        try:
+            smt2, timeout_ms = conn.recv()
+        except EOFError:
+            return
+        conn.send(solve_smt2(smt2, timeout_ms, tactics))
+
+class SolverPortfolio:
+    """ Races several tactic pipelines on each query and takes the first definitive answer.
+
+    Each strategy has a long-lived worker process with its own Z3 context.
+    Once one answers sat or unsat, the others are still busy on a query
+    that no longer matters, so they are killed and respawned on next use.
+    Wins and the winners' solve times are kept per strategy, to show which
+    defaults pay off on real traffic.
+    """
+
+    # Slack over the solver timeout before a worker that hasn't answered is killed
+    GRACE_SECONDS = 0.5
+
+    def __init__(self, strategies=DEFAULT_PORTFOLIO):
+        unknown_names = [name for name in strategies if name not in STRATEGIES]
+        if unknown_names:
+            raise ValueError(f"Unknown solver strategies: {', '.join(unknown_names)}")
+        self.strategies = tuple(strategies)
+        self._workers = {}
+        self.races = 0
+        self.undecided = 0
+        self.wins = {name: 0 for name in self.strategies}
+        self.win_time = {name: 0.0 for name in self.strategies}
+
+    def _connection(self, name):
+        worker = self._workers.get(name)
+        if worker is None or not worker[0].is_alive():
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_portfolio_worker, args=(STRATEGIES[name], child), daemon=True)
+            process.start()
+            child.close()
+            worker = self._workers[name] = (process, conn)
+        return worker[1]
+
+    def _kill(self, name):
+        process, conn = self._workers.pop(name)
+        process.kill()
+        process.join()
+        conn.close()
+
+    def solve(self, query, timeout_ms=None, deadline=None):
+        """ ("sat" | "unsat" | "unknown", model values if sat) for a Z3 formula """
+        solver = Solver()
+        solver.add(query)
+        smt2 = solver.to_smt2()
+        budget = _budget_ms(timeout_ms, deadline) or DEFAULT_REMOTE_TIMEOUT_MS
+
+        start = time.monotonic()
+        give_up = start + budget / 1000 + self.GRACE_SECONDS
+        answer = ("unknown", None)
+        winner = None
+        pending = {}
+        try:
+            for name in self.strategies:
+                conn = self._connection(name)
+                pending[conn] = name
+                conn.send((smt2, budget))
+
+            while pending and winner is None:
+                ready = wait_connections(list(pending), max(0.0, give_up - time.monotonic()))
+                if not ready:
+                    break
+                for conn in ready:
+                    name = pending.pop(conn)
+                    try:
+                        result, values = conn.recv()
+                    except EOFError:
+                        continue
+                    if result in ("sat", "unsat"):
+                        answer, winner = (result, values), name
+                        break
+        finally:
+            # Also on interruption (e.g. a CPU limit), so no worker is left with a stale answer
+            for name in pending.values():
+                self._kill(name)
+
+        self.races += 1
+        if winner is None:
+            self.undecided += 1
+        else:
+            self.wins[winner] += 1
+            self.win_time[winner] += time.monotonic() - start
+        return answer
+
+    def stats(self):
+        return {"races": self.races, "undecided": self.undecided, "wins": dict(self.wins),
+                "win_time": dict(self.win_time)}
+
+    def close(self):
+        for name in list(self._workers):
+            self._kill(name)
+
+def reference_inputs(target_src, theory=INT_THEORY, limit=64):
+    """ An input reaching each feasible path of the reference, from Z3 models.
+
+    Empty when the reference itself can't be executed symbolically.
+    """
+    func = function_def(target_src)
+    inputs = {arg.arg: theory.var(arg.arg) for arg in func.args.args}
+    try:
+        paths, _ = reference_paths.get(target_src, inputs, theory=theory)
+    except (NotImplementedError, ValueError, Z3Exception):
+        return []
+
+    solver = Solver()
+    solver.set("timeout", 200)
+    seeds = []
+    for path in paths[:limit]:
+        solver.push()
+        solver.add(path["pc"])
+        if solver.check() == sat:
+            model = solver.model()
+            seeds.append(tuple(to_python(model.eval(symbol, model_completion=True)) for symbol in inputs.values()))
+        solver.pop()
+    return seeds
+
+def _check_concretely(target_src, user_src, theory, unsupported, pool, deadline):
+    start = time.perf_counter()
+    tried, counterexample = differential_check(target_src, user_src, reference_inputs(target_src, theory),
+                                               pool=pool, deadline=deadline)
+    if counterexample is not None:
+        verdict, reason = "different", None
+    else:
+        verdict, reason = "unknown", f"no difference on {tried} generated inputs ({unsupported})"
+    result = {
+        "verdict": verdict,
+        "reason": reason,
+        "counterexample": counterexample,
+        "method": "differential",
+        "inputs_tested": tried,
+    }
+    return result, {"differential": time.perf_counter() - start}
+
+def _confirm_concretely(target_src, user_src, target_func, user_func, result, theory, pool, deadline):
+    """ (result, whether it can be cached) once a symbolic verdict has been checked against Python.
+
+    A counterexample is reported as found by running both functions on it,
+    since Z3 may rely on bit-vector overflow, a fractional input, or a
+    value for a division by zero that Python would raise on. Bit-vector
+    equivalence only covers 32-bit inputs, so it is followed by a search
+    for a difference on larger ones and is at best "unknown".
+    """
+    if result["verdict"] == "different":
+        values = result["counterexample"]["inputs"]
+        params = [arg.arg for arg in target_func.args.args]
+        if not all(name in values for name in params):
+            # Symbolic inputs that aren't parameters (e.g. a list's length) can't be run
+            if _is_exact(theory, target_func, user_func):
+                return result, True
+            return {**result, "verdict": "unknown", "counterexample": None,
+                    "reason": f"the {theory.name} counterexample can't be run to confirm it"}, False
+        seed = tuple(values[name] for name in params)
+        _, counterexample = differential_check(target_src, user_src, [seed], count=1, pool=pool, deadline=deadline)
+        if counterexample is None:
+            return {**result, "verdict": "unknown", "counterexample": None,
+                    "reason": f"the {theory.name} counterexample doesn't reproduce in Python"}, False
+        return {**result, "counterexample": counterexample}, True
+
+    if result["verdict"] == "equivalent" and isinstance(theory, BitVecTheory):
+        tried, counterexample = differential_check(target_src, user_src, pool=pool, deadline=deadline)
+        if counterexample is not None:
+            return {**result, "verdict": "different", "counterexample": counterexample, "method": "differential",
+                    "inputs_tested": tried}, True
+        return {**result, "verdict": "unknown", "inputs_tested": tried,
+                "reason": f"equivalent on {theory.width}-bit inputs, no difference on {tried} generated inputs"}, False
+    return result, True
+
+def check_equivalence(target_src, user_src, variables=None, timeout_ms=None, pool=None, deadline_s=None,
+                      cache=None, theory="auto", portfolio=None, fallback=True, sandbox=None):
+    """ Checks that user_src returns what target_src returns on every input.
+
+    variables names the symbolic inputs; by default they are the target
+    function's parameters, and the user function's parameters are bound to
+    them by position. timeout_ms bounds each solver call and deadline_s the
+    whole check. With a process pool the per-path queries are solved in
+    parallel. Returns a dict with the verdict ("equivalent", "different"
+    or "unknown"), a counterexample for "different", the theory used, path
+    and solver statistics, and timings in seconds.
+
+    Code the symbolic executor doesn't support is checked by differential
+    testing instead (see differential_testing.py), seeded with an input for
+    each path of the reference; that can only find differences, so
+    "unknown" is the best it reports. With fallback=False such code raises
+    NotImplementedError or ValueError. SyntaxError is raised either way.
+    The functions are only ever run in sandbox, a process pool that
+    should be created with differential_testing.limit_worker_memory as its
+    initializer; without one they run in pool, or in this process.
+
+    theory is "int", "real", "bitvec" or "auto", which picks one with
+    choose_theory and retries an Int check that timed out with bit-vectors,
+    where nonlinear arithmetic is decidable. Counterexamples are confirmed
+    by running both functions on them, and bit-vector equivalence, which is
+    bounded, is reported as "unknown" (see _confirm_concretely).
+
+    portfolio is an optional SolverPortfolio that races tactic pipelines on
+    each query (when no pool is given); the result then counts the wins per
+    strategy. cache is an optional VerdictCache (see verdict_cache.py);
+    verdicts that depended on a solver timeout or weren't confirmed, and
+    those from differential testing, are not stored in it.
+    """
+    start = time.perf_counter()
+    if cache is not None:
+        key = verdict_key(target_src, user_src, variables, theory)
+        cached = cache.get(key)
+        if cached is not None:
+            return {**cached, "cached": True, "timings": {"total": time.perf_counter() - start}}
+
+    deadline = time.monotonic() + deadline_s if deadline_s else None
+    if sandbox is None:
+        sandbox = pool
+    target_func = function_def(target_src)
+    user_func = function_def(user_src)
+    if theory == "auto":
+        theories = [choose_theory(target_func, user_func)]
+        if theories[0] is INT_THEORY:
+            theories.append(BITVEC_THEORY)
+    else:
+        theories = [THEORIES[theory]]
 
-if not any_bug:
-    print("All target (golden) paths are correctly handled in user code.")
+    timings = {}
+    wins_before = dict(portfolio.wins) if portfolio is not None else None
+    try:
+        for candidate in theories:
+            result, undecided, attempt = _check_in_theory(target_src, user_src, target_func, user_func, variables,
+                                                          candidate, timeout_ms, pool, deadline, portfolio)
+            for stage, seconds in attempt.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+            if not undecided or (deadline is not None and time.monotonic() >= deadline):
+                break
+        confirm_start = time.perf_counter()
+        result, confirmed = _confirm_concretely(target_src, user_src, target_func, user_func, result, candidate,
+                                                sandbox, deadline)
+        undecided = undecided or not confirmed
+        timings["confirm"] = time.perf_counter() - confirm_start
+    except (NotImplementedError, ValueError, Z3Exception) as e:
+        if not fallback:
+            raise
+        result, attempt = _check_concretely(target_src, user_src, theories[0], str(e), sandbox, deadline)
+        # Its verdicts depend on the order operands are evaluated in (which exception is raised first),
+        # which the cache key doesn't keep, and on how many inputs it got through before the deadline
+        undecided = True
+        timings.update(attempt)
+    timings["total"] = time.perf_counter() - start
+    if cache is not None and not undecided:
+        cache.put(key, result)
+    if portfolio is not None:
+        result["strategy_wins"] = {name: wins - wins_before[name] for name, wins in portfolio.wins.items()
+                                   if wins > wins_before[name]}
+    return {**result, "cached": False, "timings": timings}
 
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("usage: generate_z3.py TARGET_FILE USER_FILE [VARIABLE ...]")
+    with open(sys.argv[1]) as f:
+        target_src = f.read()
+    with open(sys.argv[2]) as f:
+        user_src = f.read()
+    print(json.dumps(check_equivalence(target_src, user_src, sys.argv[3:] or None), indent=2))
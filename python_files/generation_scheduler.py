@@ -0,0 +1,240 @@
+import asyncio
+import queue
+import threading
+import time
+
+import torch
+from transformers import (LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList,
+                          TextIteratorStreamer)
+
+# Sampling at temperature 0 is greedy decoding; dividing by this instead keeps the maths finite
+MIN_TEMPERATURE = 1e-4
+
+
+class PendingGeneration:
+    __slots__ = ("prompt", "temperature", "max_tokens", "future", "loop", "enqueued")
+
+    def __init__(self, prompt, temperature, max_tokens, future, loop):
+        self.prompt = prompt
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.future = future
+        self.loop = loop
+        self.enqueued = time.monotonic()
+
+
+def _settle(future, result, error):
+    # The request may have been cancelled (client gone) while its batch ran
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class GenerationScheduler:
+    """ Dynamic batching of generation requests on a dedicated worker thread.
+
+    submit() queues a prompt and awaits its result without blocking the
+    event loop. The worker takes the oldest request, waits up to max_wait_s
+    for more (less if the queue already holds enough) and hands at most
+    max_batch_size of them to generate, which gets a list of
+    PendingGeneration and returns one string per request. Requests whose
+    caller has gone away by then are dropped from the batch. When max_queue
+    requests are waiting, submit raises queue.Full. on_batch(batch, seconds)
+    is called after every batch, for metrics.
+    """
+
+    def __init__(self, generate, max_batch_size=8, max_wait_s=0.01, max_queue=256, on_batch=None):
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self.on_batch = on_batch
+        self.running = 0
+        self._closing = False
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    async def submit(self, prompt, temperature, max_tokens):
+        loop = asyncio.get_running_loop()
+        pending = PendingGeneration(prompt, temperature, max_tokens, loop.create_future(), loop)
+        self._queue.put_nowait(pending)
+        return await pending.future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # close() was called; finish this batch, then stop
+                self._closing = True
+                break
+            batch.append(item)
+        return [pending for pending in batch if not pending.future.cancelled()]
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._collect(first)
+            if batch:
+                self._run_batch(batch)
+            if self._closing:
+                break
+
+        # Anything submitted after close() won't be run
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if pending is not None:
+                pending.loop.call_soon_threadsafe(_settle, pending.future, None,
+                                                  RuntimeError("generation scheduler is closed"))
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        self.running = len(batch)
+        try:
+            results, error = self.generate(batch), None
+        except Exception as e:
+            results, error = [None] * len(batch), e
+        finally:
+            self.running = 0
+        for pending, result in zip(batch, results):
+            pending.loop.call_soon_threadsafe(_settle, pending.future, result, error)
+        if self.on_batch is not None:
+            self.on_batch(batch, time.perf_counter() - started)
+
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+class RowTemperature(LogitsProcessor):
+    """ Divides each row's logits by its own temperature, so one batch can mix sampling settings """
+
+    def __init__(self, temperatures):
+        self.temperatures = temperatures.unsqueeze(1)
+
+    def __call__(self, input_ids, scores):
+        return scores / self.temperatures.to(scores.dtype)
+
+
+def transformers_batch_generator(model, tokenizer):
+    """ A generate function for GenerationScheduler running a causal LM on padded batches.
+
+    Prompts are left-padded so every row continues from its last real
+    token. The batch decodes for the largest max_tokens in it and each
+    result is cut to its own request's limit.
+    """
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    def generate(batch):
+        inputs = tokenizer([pending.prompt for pending in batch], return_tensors="pt", padding=True).to(model.device)
+        temperatures = torch.tensor([max(pending.temperature, MIN_TEMPERATURE) for pending in batch],
+                                    device=model.device)
+        with torch.inference_mode():
+            output = model.generate(
+                **inputs,
+                do_sample=True,
+                # Temperature is applied per row by RowTemperature, not by generate
+                temperature=1.0,
+                max_new_tokens=max(pending.max_tokens for pending in batch),
+                logits_processor=LogitsProcessorList([RowTemperature(temperatures)]),
+                pad_token_id=tokenizer.pad_token_id
+            )
+        generated = output[:, inputs["input_ids"].shape[1]:]
+        return [tokenizer.decode(tokens[:pending.max_tokens], skip_special_tokens=True).strip()
+                for tokens, pending in zip(generated, batch)]
+
+    return generate
+
+
+class StopGeneration(StoppingCriteria):
+    """ Ends a single-row generation when cancelled is set or a stop sequence shows up in the new text """
+
+    def __init__(self, tokenizer, prompt_length, stop_sequences, cancelled):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_sequences = stop_sequences
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.cancelled.is_set():
+            return True
+        if not self.stop_sequences:
+            return False
+        # Leading whitespace doesn't count, so an answer starting with a newline isn't cut off
+        text = self.tokenizer.decode(input_ids[0, self.prompt_length:], skip_special_tokens=True).lstrip()
+        return any(stop in text for stop in self.stop_sequences)
+
+
+def cut_at_stop(text, stop_sequences):
+    """ (text up to the first stop sequence, whether one was found), ignoring leading whitespace """
+    body = text.lstrip()
+    positions = [body.find(stop) for stop in stop_sequences if stop in body]
+    if not positions:
+        return text, False
+    return text[:len(text) - len(body) + min(positions)], True
+
+
+def partial_stop(text, stop_sequences):
+    """ Length of the longest end of text that could be the start of a stop sequence """
+    longest = 0
+    for stop in stop_sequences:
+        for size in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:size]):
+                longest = size
+                break
+    return longest
+
+
+def stream_generation(model, tokenizer, prompt, temperature, max_tokens, stop_sequences, cancelled):
+    """ Starts generating prompt on a thread and returns an iterator over the text as it is decoded.
+
+    Set cancelled to stop the generation at the next token, e.g. when the
+    client has disconnected. Batched generation can't be streamed per row,
+    so each stream runs on its own. The tokenizer is used from several
+    threads at once, so it mustn't be one that is also used for padded
+    batches: a fast tokenizer whose padding is changed while another thread
+    uses it fails with "Already borrowed". Streams never pad, so they can
+    share one.
+    """
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stopping = StopGeneration(tokenizer, inputs["input_ids"].shape[1], stop_sequences, cancelled)
+
+    def run():
+        try:
+            with torch.inference_mode():
+                model.generate(
+                    **inputs,
+                    do_sample=True,
+                    temperature=max(temperature, MIN_TEMPERATURE),
+                    max_new_tokens=max_tokens,
+                    stopping_criteria=StoppingCriteriaList([stopping]),
+                    streamer=streamer,
+                    pad_token_id=tokenizer.eos_token_id if tokenizer.pad_token_id is None else tokenizer.pad_token_id
+                )
+        except Exception:
+            # Unblock the reader; what was generated so far has been streamed
+            streamer.end()
+            raise
+
+    threading.Thread(target=run, name="generation-stream", daemon=True).start()
+    return iter(streamer)
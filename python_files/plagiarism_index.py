@@ -0,0 +1,283 @@
+import ast
+import builtins
+import functools
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Mersenne prime for the MinHash permutations; fingerprints are 32-bit so
+# a * x + b stays below 2**64 and the arithmetic can be done in uint64.
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+_BUILTINS = frozenset(dir(builtins))
+
+
+def normalized_tokens(source):
+    """ Pre-order stream of node types with identifiers and literals normalized away.
+
+    Local names, arguments and attributes all become ID (builtins such as
+    len or range are kept), and constants become their type, so renaming
+    variables or changing literals doesn't change the stream.
+    """
+    tree = ast.parse(source)
+    tokens = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.expr_context):
+            continue
+        if isinstance(node, ast.Name):
+            tokens.append(node.id if node.id in _BUILTINS else "ID")
+        elif isinstance(node, ast.Constant):
+            tokens.append(type(node.value).__name__.upper())
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            continue  # docstrings and bare string statements
+        else:
+            tokens.append(type(node).__name__)
+        children = list(ast.iter_child_nodes(node))
+        stack.extend(reversed(children))
+    return tokens
+
+
+def _hash32(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), "little")
+
+
+def winnow(tokens, k=5, window=4):
+    """ Winnowed k-gram fingerprints (Schleimer et al.): the minimum hash of each window """
+    if len(tokens) < k:
+        return {_hash32(" ".join(tokens).encode())} if tokens else set()
+
+    hashes = [_hash32(" ".join(tokens[i:i + k]).encode()) for i in range(len(tokens) - k + 1)]
+    if len(hashes) <= window:
+        return {min(hashes)}
+
+    fingerprints = set()
+    for start in range(len(hashes) - window + 1):
+        fingerprints.add(min(hashes[start:start + window]))
+    return fingerprints
+
+
+@functools.lru_cache(maxsize=None)
+def _permutations(num_perm):
+    # Fixed seed: signatures are stored, so every process must hash the same way
+    rng = np.random.RandomState(1)
+    return (rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64),
+            rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64))
+
+
+def minhash(fingerprints, num_perm=128):
+    """ MinHash signature of a fingerprint set; every entry is the maximum hash for an empty one """
+    if not fingerprints:
+        return np.full(num_perm, _MAX_HASH, dtype=np.uint64)
+    a, b = _permutations(num_perm)
+    x = np.fromiter(fingerprints, dtype=np.uint64, count=len(fingerprints))
+    hashed = (a[:, None] * x[None, :] + b[:, None]) % _PRIME & _MAX_HASH
+    return hashed.min(axis=1)
+
+
+def source_signature(source, num_perm=128, k=5, window=4):
+    """ MinHash signature of source's winnowed fingerprints; the CPU-heavy part of add() and query() """
+    return minhash(winnow(normalized_tokens(source), k, window), num_perm)
+
+
+class FingerprintIndex:
+    """ MinHash/LSH index over winnowed AST fingerprints, persisted in a directory.
+
+    Layout:
+      meta.json        parameters and how many documents the bucket files cover
+      ids.jsonl        one submission id per line, in insertion order
+      signatures.bin   raw uint64 MinHash signatures, one row per submission
+      bucket_keys.npy  sorted LSH band keys (uint64) for compacted documents
+      bucket_docs.npy  document number for each key
+
+    Signatures and buckets are memory-mapped. New submissions are appended
+    to signatures.bin and kept in an in-memory bucket table until the next
+    compact(), which merges them into the sorted bucket files. Submission
+    ids are unique; adding one that is already indexed raises KeyError.
+    Signatures can be computed elsewhere (e.g. in a worker process) with
+    source_signature and this index's parameters, and passed to
+    add_signature() and query_signature().
+    """
+
+    def __init__(self, path, num_perm=128, bands=32, k=5, window=4, compact_every=10000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        meta = self._read_meta()
+        if meta is None:
+            meta = {"num_perm": num_perm, "bands": bands, "k": k, "window": window, "compacted": 0}
+            self._write_meta(meta)
+        self.num_perm = meta["num_perm"]
+        self.bands = meta["bands"]
+        self.rows = self.num_perm // self.bands
+        self.k = meta["k"]
+        self.window = meta["window"]
+        self._compacted = meta["compacted"]
+
+        self.ids = []
+        if os.path.exists(self._file("ids.jsonl")):
+            with open(self._file("ids.jsonl"), encoding="utf-8") as f:
+                self.ids = [json.loads(line) for line in f if line.strip()]
+        self._id_set = set(self.ids)
+
+        self._signatures = self._map_signatures()
+        self._bucket_keys, self._bucket_docs = self._load_buckets()
+
+        # Documents appended since the last compaction
+        self._pending = {}
+        for doc in range(self._compacted, len(self.ids)):
+            for key in self._band_keys(self._signatures[doc]):
+                self._pending.setdefault(key, []).append(doc)
+
+    # --- persistence ---
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        try:
+            with open(self._file("meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        tmp = self._file("meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file("meta.json"))
+
+    def _map_signatures(self):
+        n = len(self.ids)
+        # A crash between the two appends in add() can leave an orphaned signature row
+        row_bytes = self.num_perm * 8
+        sig_file = self._file("signatures.bin")
+        if os.path.exists(sig_file) and os.path.getsize(sig_file) > n * row_bytes:
+            os.truncate(sig_file, n * row_bytes)
+        if n == 0:
+            return np.zeros((0, self.num_perm), dtype=np.uint64)
+        return np.memmap(self._file("signatures.bin"), dtype=np.uint64, mode="r", shape=(n, self.num_perm))
+
+    def _load_buckets(self):
+        if not os.path.exists(self._file("bucket_keys.npy")):
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)
+        return (np.load(self._file("bucket_keys.npy"), mmap_mode="r"),
+                np.load(self._file("bucket_docs.npy"), mmap_mode="r"))
+
+    # --- hashing ---
+
+    def fingerprints(self, source):
+        return winnow(normalized_tokens(source), self.k, self.window)
+
+    def signature(self, fingerprints):
+        return minhash(fingerprints, self.num_perm)
+
+    def source_signature(self, source):
+        return source_signature(source, self.num_perm, self.k, self.window)
+
+    def _band_keys(self, signature):
+        keys = []
+        for band in range(self.bands):
+            chunk = np.ascontiguousarray(signature[band * self.rows:(band + 1) * self.rows])
+            digest = hashlib.blake2b(band.to_bytes(2, "little") + chunk.tobytes(), digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little"))
+        return keys
+
+    # --- public API ---
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, submission_id):
+        return submission_id in self._id_set
+
+    def add(self, submission_id, source):
+        """ Indexes one submission; returns its document number """
+        return self.add_signature(submission_id, self.source_signature(source))
+
+    def add_signature(self, submission_id, signature):
+        with self._lock:
+            if submission_id in self._id_set:
+                raise KeyError(f"Submission {submission_id!r} is already indexed")
+            doc = len(self.ids)
+            with open(self._file("signatures.bin"), "ab") as f:
+                f.write(signature.astype(np.uint64).tobytes())
+            with open(self._file("ids.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(submission_id) + "\n")
+            self.ids.append(submission_id)
+            self._id_set.add(submission_id)
+            for key in self._band_keys(signature):
+                self._pending.setdefault(key, []).append(doc)
+            self._signatures = self._map_signatures()
+            if len(self.ids) - self._compacted >= self.compact_every:
+                self._compact_locked()
+        return doc
+
+    def query(self, source, top_k=5, min_similarity=0.0, exclude=None):
+        """ Most similar indexed submissions as (submission_id, estimated Jaccard) pairs """
+        return self.query_signature(self.source_signature(source), top_k, min_similarity, exclude)
+
+    def query_signature(self, signature, top_k=5, min_similarity=0.0, exclude=None):
+        if (signature == _MAX_HASH).all():
+            return []
+
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                lo = np.searchsorted(self._bucket_keys, np.uint64(key), side="left")
+                hi = np.searchsorted(self._bucket_keys, np.uint64(key), side="right")
+                candidates.update(int(doc) for doc in self._bucket_docs[lo:hi])
+                candidates.update(self._pending.get(key, ()))
+            if not candidates:
+                return []
+
+            docs = np.fromiter(sorted(candidates), dtype=np.int64, count=len(candidates))
+            scores = (self._signatures[docs] == signature[None, :]).mean(axis=1)
+            ids = self.ids
+
+        order = np.argsort(-scores, kind="stable")
+        results = []
+        for i in order:
+            submission_id = ids[docs[i]]
+            if submission_id == exclude or scores[i] < min_similarity:
+                continue
+            results.append((submission_id, float(scores[i])))
+            if len(results) >= top_k:
+                break
+        return results
+
+    def compact(self):
+        """ Merges pending bucket entries into the sorted, memory-mapped bucket files """
+        with self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        if not self._pending:
+            return
+        new_keys = np.fromiter((key for key, docs in self._pending.items() for _ in docs), dtype=np.uint64)
+        new_docs = np.fromiter((doc for docs in self._pending.values() for doc in docs), dtype=np.uint32)
+        keys = np.concatenate([np.asarray(self._bucket_keys), new_keys])
+        docs = np.concatenate([np.asarray(self._bucket_docs), new_docs])
+        order = np.argsort(keys, kind="stable")
+
+        # Release the old maps before replacing the files underneath them
+        self._bucket_keys = self._bucket_docs = None
+        for name, array in (("bucket_keys.npy", keys[order]), ("bucket_docs.npy", docs[order])):
+            tmp = self._file(name + ".tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, self._file(name))
+
+        self._compacted = len(self.ids)
+        self._pending = {}
+        self._write_meta({"num_perm": self.num_perm, "bands": self.bands, "k": self.k,
+                          "window": self.window, "compacted": self._compacted})
+        self._bucket_keys, self._bucket_docs = self._load_buckets()
@@ -1,17 +1,77 @@
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import uvicorn
 from huggingface_hub import login
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import chromadb
-from chromadb.config import Settings
+from transformers import AutoTokenizer, AutoModelForCausalLM
+import asyncio
 import json
+import logging
+import queue
+import threading
 from sentence_transformers import SentenceTransformer
 import os
+import time
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
+from context_index import open_collection, sync_collection
+from generation_scheduler import (GenerationScheduler, cut_at_stop, partial_stop, stream_generation,
+                                  transformers_batch_generator)
+from response_cache import SemanticCache
+from metrics import CONTENT_TYPE, LATENCY_BUCKETS, Counter, Gauge, Histogram, render_metrics
+
+logger = logging.getLogger("recommendation_engine")
+
+CONTEXT_FILE = os.environ.get("CONTEXT_FILE", "context_data.json")
+CONTEXT_INDEX_DIR = os.environ.get("CONTEXT_INDEX_DIR", "context_index")
+EMBEDDER_NAME = os.environ.get("EMBEDDER_NAME", "all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+# Documents per Chroma upsert, and per encode() call when the index is synced
+INDEX_BATCH_SIZE = int(os.environ.get("CONTEXT_INDEX_BATCH_SIZE", "1024"))
+GENERATOR_MODEL = os.environ.get("GENERATOR_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+RETRY_AFTER_SECONDS = int(os.environ.get("RECOMMEND_RETRY_AFTER_SECONDS", "5"))
+# Concurrent /recommend calls are generated together, in batches of up to this many
+GENERATION_MAX_BATCH_SIZE = int(os.environ.get("GENERATION_MAX_BATCH_SIZE", "8"))
+GENERATION_BATCH_WAIT_MS = float(os.environ.get("GENERATION_BATCH_WAIT_MS", "10"))
+GENERATION_MAX_QUEUE = int(os.environ.get("GENERATION_MAX_QUEUE", "256"))
+# Streams generate one at a time each, outside the batches; at most this many run at once
+GENERATION_MAX_STREAMS = int(os.environ.get("GENERATION_MAX_STREAMS", "2"))
+# Queries at least this similar to an earlier one, with the same retrieved context, reuse its answer
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+# The answer is one line, so a newline ends it, as does the model starting a new prompt section
+STOP_SEQUENCES = ("\n", "###")
+
+# Loaded in the background at startup; retrieval needs the first two
+COMPONENTS = ("embedder", "index", "generator")
+
+
+generation_batch_size = Histogram(
+    "recommend_generation_batch_size", "Requests per generation batch", (1, 2, 4, 8, 16, 32, 64))
+generation_queue_wait = Histogram(
+    "recommend_generation_queue_wait_seconds", "Time from submission to the start of its batch", LATENCY_BUCKETS)
+generation_batch_latency = Histogram(
+    "recommend_generation_batch_seconds", "Time to generate one batch", LATENCY_BUCKETS)
+generation_rejections = Counter(
+    "recommend_generation_rejections_total", "Requests turned away because the generation queue was full")
+
+response_cache_lookups = Counter(
+    "recommend_response_cache_lookups_total", "Semantic response cache lookups", labelnames=("result",))
+
+# Answers keyed by query embedding; emptied whenever the context index changes
+response_cache = SemanticCache(RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+
+
+def record_batch(batch, seconds):
+    generation_batch_size.observe(len(batch))
+    generation_batch_latency.observe(seconds)
+    started = time.monotonic() - seconds
+    for pending in batch:
+        generation_queue_wait.observe(started - pending.enqueued)
+
 
 def load_context_from_file(filename="context_data.json"):
     try:
@@ -27,60 +87,102 @@ class QueryRequest(BaseModel):
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = 200
 
+class StreamQueryRequest(QueryRequest):
+    # None uses STOP_SEQUENCES; an empty list generates up to max_tokens
+    stop: Optional[List[str]] = None
+
 class RecommendationResponse(BaseModel):
     query: str
     context: List[str]
-    recommendation: str
+    recommendation: Optional[str]
+    # True when the generator is still loading and only the retrieved context is returned
+    degraded: bool = False
+    # True when the recommendation was reused from a near-identical earlier query
+    cached: bool = False
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Load embedder
-    app.state.embedder = SentenceTransformer('all-MiniLM-L6-v2')
-    
-    # Load context
-    app.state.context_data = load_context_from_file()
-    
-    # Extract and embed texts
-    texts = []
-    for item in app.state.context_data:
-        combined = " | ".join(str(value) for value in item.values() if isinstance(value, str))
-        texts.append(combined)
-    
-    app.state.embeddings = app.state.embedder.encode(texts)
-    
-    # Set up ChromaDB
-    app.state.client = chromadb.Client(Settings(anonymized_telemetry=False))
-    # Use get_or_create to handle restarts
-    try:
-        app.state.collection = app.state.client.create_collection("tech_stacks")
-        # Add docs
-        for i, doc in enumerate(texts):
-            app.state.collection.add(
-                documents=[doc],
-                ids=[str(i)],
-                embeddings=[app.state.embeddings[i]]
-            )
-    except:
-        # Collection already exists
-        app.state.collection = app.state.client.get_collection("tech_stacks")
-    
-    # Set up HuggingFace model
-    model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
-    
-    app.state.tokenizer = AutoTokenizer.from_pretrained(model_name)
+def load_embedder(app):
+    app.state.embedder = SentenceTransformer(EMBEDDER_NAME)
+
+
+def load_index(app):
+    app.state.context_data = load_context_from_file(CONTEXT_FILE)
+    # Persistent index: only new or edited items are embedded, removed ones are deleted
+    app.state.client, app.state.collection = open_collection(CONTEXT_INDEX_DIR, "tech_stacks", EMBEDDER_NAME)
+    app.state.index_sync = sync_collection(
+        app.state.collection,
+        lambda texts: app.state.embedder.encode(texts, batch_size=EMBED_BATCH_SIZE).tolist(),
+        app.state.context_data,
+        batch_size=INDEX_BATCH_SIZE
+    )
+    logger.info("context index: %(added)d added, %(removed)d removed, %(unchanged)d unchanged",
+                app.state.index_sync)
+    response_cache.set_version(app.state.index_sync["version"])
+
+
+def load_generator(app):
+    app.state.tokenizer = AutoTokenizer.from_pretrained(GENERATOR_MODEL)
+    # The scheduler pads its batches, which reconfigures the tokenizer, so streams (which
+    # encode and decode on other threads at the same time) get an instance of their own
+    app.state.stream_tokenizer = AutoTokenizer.from_pretrained(GENERATOR_MODEL)
     app.state.model = AutoModelForCausalLM.from_pretrained(
-        model_name,
+        GENERATOR_MODEL,
         device_map="auto",
         torch_dtype="auto"
     )
     
-    app.state.gen_pipeline = pipeline("text-generation", 
-                                     model=app.state.model, 
-                                     tokenizer=app.state.tokenizer)
+    app.state.scheduler = GenerationScheduler(
+        transformers_batch_generator(app.state.model, app.state.tokenizer),
+        max_batch_size=GENERATION_MAX_BATCH_SIZE,
+        max_wait_s=GENERATION_BATCH_WAIT_MS / 1000,
+        max_queue=GENERATION_MAX_QUEUE,
+        on_batch=record_batch
+    )
+
+
+async def start_component(app, name, load, after=()):
+    """ Runs load(app) in a thread once the components in `after` are up, recording its status """
+    components = app.state.components
+    try:
+        for dependency in after:
+            await dependency
+        started = time.perf_counter()
+        await asyncio.to_thread(load, app)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception("failed to load %s", name)
+        components[name] = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+        raise
+    components[name] = {"status": "ready", "seconds": round(time.perf_counter() - started, 3)}
+
+
+def component_ready(name):
+    return app.state.components[name]["status"] == "ready"
+
+
+def retrieval_ready():
+    return component_ready("embedder") and component_ready("index")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The app starts taking requests right away; the embedder and the
+    # generator load concurrently and the index is synced once the embedder
+    # is up. /health/ready tells the load balancer when retrieval works.
+    app.state.components = {name: {"status": "loading"} for name in COMPONENTS}
+    app.state.stream_slots = asyncio.Semaphore(GENERATION_MAX_STREAMS)
+    embedder = asyncio.create_task(start_component(app, "embedder", load_embedder))
+    index = asyncio.create_task(start_component(app, "index", load_index, after=[embedder]))
+    generator = asyncio.create_task(start_component(app, "generator", load_generator))
+    app.state.startup_tasks = [embedder, index, generator]
     
     yield
     
-    # Cleanup code would go here (if needed)
+    for task in app.state.startup_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.startup_tasks, return_exceptions=True)
+    if getattr(app.state, "scheduler", None) is not None:
+        app.state.scheduler.close(timeout=5)
 
 app = FastAPI(
     title="Tech Stack Recommendation API", 
@@ -101,21 +203,26 @@ app.add_middleware(
     allow_headers=["*"],              # Allow all headers
 )
 
-@app.post("/recommend", response_model=RecommendationResponse)
-async def recommend_stack(request: QueryRequest = Body(...)):
+def retrieve_context(query, max_results):
+    """ (documents, their ids, the query embedding) """
     # Create query embedding
-    query_embedding = app.state.embedder.encode([request.query])[0]
+    query_embedding = app.state.embedder.encode([query])[0]
     
     # Retrieve relevant context
     results = app.state.collection.query(
         query_embeddings=[query_embedding],
-        n_results=request.max_results
+        n_results=max_results
     )
     
-    retrieved_docs = results['documents'][0]
-    
-    # Generate recommendation
-    prompt = f"""### Instruction:
+    return results['documents'][0], results['ids'][0], query_embedding
+
+def cached_answer(query_embedding, context_key):
+    answer = response_cache.get(query_embedding, context_key)
+    response_cache_lookups.inc(result="miss" if answer is None else "hit")
+    return answer
+
+def build_prompt(query, retrieved_docs):
+    return f"""### Instruction:
     You are an expert mentor for CS students.
     Based on the context below, answer the user's query with a tech stack recommendation in one line only.
 
@@ -123,20 +230,57 @@ async def recommend_stack(request: QueryRequest = Body(...)):
     {retrieved_docs}
 
     ### Query:
-    {request.query}
+    {query}
 
     ### Response:
     """
+
+@app.post("/recommend", response_model=RecommendationResponse)
+async def recommend_stack(request: QueryRequest = Body(...)):
+    if not retrieval_ready():
+        raise HTTPException(status_code=503, detail="The context index is still loading",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
     
-    response = app.state.gen_pipeline(
-        prompt, 
-        do_sample=True, 
-        max_new_tokens=request.max_tokens, 
-        temperature=request.temperature, 
-        return_full_text=False
-    )
+    retrieved_docs, doc_ids, query_embedding = await asyncio.to_thread(
+        retrieve_context, request.query, request.max_results)
+    max_tokens = 200 if request.max_tokens is None else request.max_tokens
+    temperature = 0.7 if request.temperature is None else request.temperature
     
-    recommendation = response[0]["generated_text"].strip()
+    # Near-duplicate questions over the same context and settings skip the LLM entirely
+    context_key = (tuple(doc_ids), max_tokens, temperature, None)
+    recommendation = cached_answer(query_embedding, context_key)
+    if recommendation is not None:
+        return RecommendationResponse(
+            query=request.query,
+            context=retrieved_docs,
+            recommendation=recommendation,
+            cached=True
+        )
+    
+    if not component_ready("generator"):
+        return RecommendationResponse(
+            query=request.query,
+            context=retrieved_docs,
+            recommendation=None,
+            degraded=True
+        )
+    
+    # Generate recommendation
+    prompt = build_prompt(request.query, retrieved_docs)
+    
+    # Queued with other concurrent requests and generated in a batch off the event loop
+    try:
+        recommendation = await app.state.scheduler.submit(
+            prompt,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+    except queue.Full:
+        generation_rejections.inc()
+        raise HTTPException(status_code=503, detail="Too many recommendations in progress, try again shortly",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    if recommendation:
+        response_cache.put(query_embedding, context_key, recommendation)
     
     return RecommendationResponse(
         query=request.query,
@@ -144,9 +288,126 @@ async def recommend_stack(request: QueryRequest = Body(...)):
         recommendation=recommendation
     )
 
+@app.post("/recommend/stream")
+async def recommend_stack_stream(http_request: Request, request: StreamQueryRequest = Body(...)):
+    """ NDJSON stream: the retrieved context first, then generated text as it is produced, then a summary.
+
+    Lines are {"type": "context", ...}, any number of {"type": "token",
+    "text": ...} and finally {"type": "done", "recommendation": ...,
+    "reason": "stop" | "end" | "cached" | "degraded" | "disconnected"}.
+    Generation is cancelled as soon as the client goes away.
+    """
+    if not retrieval_ready():
+        raise HTTPException(status_code=503, detail="The context index is still loading",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    
+    retrieved_docs, doc_ids, query_embedding = await asyncio.to_thread(
+        retrieve_context, request.query, request.max_results)
+    stop_sequences = STOP_SEQUENCES if request.stop is None else tuple(s for s in request.stop if s)
+    max_tokens = 200 if request.max_tokens is None else request.max_tokens
+    temperature = 0.7 if request.temperature is None else request.temperature
+    context_key = (tuple(doc_ids), max_tokens, temperature, stop_sequences)
+    
+    async def events():
+        cached = cached_answer(query_embedding, context_key)
+        degraded = cached is None and not component_ready("generator")
+        yield json.dumps({"type": "context", "query": request.query, "context": retrieved_docs,
+                          "degraded": degraded}) + "\n"
+        if cached is not None:
+            yield json.dumps({"type": "token", "text": cached}) + "\n"
+            yield json.dumps({"type": "done", "recommendation": cached, "reason": "cached"}) + "\n"
+            return
+        if degraded:
+            yield json.dumps({"type": "done", "recommendation": None, "reason": "degraded"}) + "\n"
+            return
+        
+        cancelled = threading.Event()
+        text = ""
+        sent = 0
+        reason = "end"
+        async with app.state.stream_slots:
+            # Tokenizing the prompt and moving it to the model's device happen off the event loop too
+            chunks = await asyncio.to_thread(
+                stream_generation,
+                app.state.model,
+                app.state.stream_tokenizer,
+                build_prompt(request.query, retrieved_docs),
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stop_sequences=stop_sequences,
+                cancelled=cancelled
+            )
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                    if await http_request.is_disconnected():
+                        reason = "disconnected"
+                        break
+                    # Cut on the whole text so a stop sequence split across chunks is still found,
+                    # and hold back an end that may turn out to be the start of one
+                    if chunk is not None:
+                        text, stopped = cut_at_stop(text + chunk, stop_sequences)
+                    finished = chunk is None or stopped
+                    ready = len(text) if finished else len(text) - partial_stop(text, stop_sequences)
+                    if ready > sent:
+                        yield json.dumps({"type": "token", "text": text[sent:ready]}) + "\n"
+                        sent = ready
+                    if finished:
+                        reason = "end" if chunk is None else "stop"
+                        break
+            finally:
+                # Also reached when the response is cancelled because the client went away
+                cancelled.set()
+        
+        if reason != "disconnected":
+            if text.strip():
+                response_cache.put(query_embedding, context_key, text.strip())
+            yield json.dumps({"type": "done", "recommendation": text.strip(), "reason": reason}) + "\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/health")
+@app.get("/health/live")
 async def health_check():
-    return {"status": "healthy"}
+    """ Liveness: the process is up and serving, whatever is still loading """
+    return {"status": "healthy", "components": app.state.components}
+
+@app.get("/health/ready")
+async def readiness_check(response: Response):
+    """ Readiness: retrieval works; degraded until the generator is loaded too """
+    ready = retrieval_ready()
+    if not ready:
+        response.status_code = 503
+    return {
+        "ready": ready,
+        "degraded": ready and not component_ready("generator"),
+        "components": app.state.components,
+    }
+
+@app.get("/metrics")
+def metrics():
+    """ Prometheus scrape endpoint """
+    scheduler = getattr(app.state, "scheduler", None)
+    body = render_metrics(
+        generation_batch_size, generation_queue_wait, generation_batch_latency, generation_rejections,
+        Gauge("recommend_generation_queue_depth", "Requests waiting for a generation batch",
+              lambda: scheduler.queue_depth if scheduler else 0),
+        Gauge("recommend_generation_running", "Requests in the batch being generated",
+              lambda: scheduler.running if scheduler else 0),
+        response_cache_lookups,
+        Gauge("recommend_response_cache_entries", "Answers in the semantic response cache",
+              lambda: response_cache.stats()["size"]),
+        Gauge("recommend_response_cache_hit_ratio", "Share of response cache lookups that were hits",
+              lambda: response_cache.stats()["hit_ratio"]),
+        Gauge("recommend_response_cache_evictions_total", "Answers evicted or expired from the response cache",
+              lambda: response_cache.evictions + response_cache.expirations, kind="counter"),
+    )
+    return PlainTextResponse(body, media_type=CONTENT_TYPE)
+
+@app.get("/recommend/cache")
+def recommend_cache():
+    """ Size, hit ratio and eviction counters for the semantic response cache """
+    return response_cache.stats()
 
 if __name__ == "__main__":
     uvicorn.run("recommendation_engine:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
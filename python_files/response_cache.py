@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache:
+    """ Bounded LRU/TTL cache of generated answers, matched by query embedding.
+
+    A lookup hits when a stored query's embedding has cosine similarity of
+    at least threshold with the new one and the same context key (the ids
+    of the retrieved documents plus any generation settings that change the
+    answer). Entries expire ttl_s seconds after they were stored. Every
+    entry belongs to an index version; set_version() with a new one drops
+    them all, since their context may no longer be what retrieval returns.
+    """
+
+    def __init__(self, threshold=0.95, max_entries=1024, ttl_s=3600.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.version = None
+        self._entries = OrderedDict()
+        # context key -> entry ids, so a lookup only compares queries that share their context
+        self._by_context = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        _, context_key, _, _ = self._entries.pop(entry_id)
+        ids = self._by_context[context_key]
+        ids.remove(entry_id)
+        if not ids:
+            del self._by_context[context_key]
+
+    def get(self, embedding, context_key):
+        """ The cached answer for a near-identical query with the same context, or None """
+        query = self._unit(embedding)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_context.get(context_key, ())):
+                vector, _, answer, expires = self._entries[entry_id]
+                if expires <= now:
+                    self._remove(entry_id)
+                    self.expirations += 1
+                    continue
+                score = float(vector @ query)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][2]
+
+    def put(self, embedding, context_key, answer):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (self._unit(embedding), context_key, answer, time.monotonic() + self.ttl_s)
+            self._by_context.setdefault(context_key, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def set_version(self, version):
+        """ Ties the cache to an index version, clearing it if that changed """
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self._by_context.clear()
+                self.version = version
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
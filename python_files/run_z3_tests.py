@@ -1,44 +1,93 @@
+import argparse
 import json
 import subprocess
 import tempfile
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-def run_generate_z3(py_file, variables):
-    """Run the generate_z3.py script with the given file and variables."""
+from generate_z3 import check_equivalence
+
+def run_generate_z3(target_file, user_file, variables):
+    """Run the generate_z3.py script on a target and a user file with the given variables.
+
+    Returns stdout, stderr and the child's resource usage (None if it couldn't be started).
+    """
     try:
-        result = subprocess.run(
-            [sys.executable, "generate_z3.py", py_file] + variables,
-            capture_output=True,
-            text=True
-        )
-        return result.stdout.strip(), result.stderr.strip()
+        # Output goes to files and the child is reaped with wait4 directly, which (unlike
+        # Popen.wait) reports its resource usage
+        with tempfile.TemporaryFile(mode="w+") as stdout, tempfile.TemporaryFile(mode="w+") as stderr:
+            process = subprocess.Popen(
+                [sys.executable, "generate_z3.py", target_file, user_file] + variables,
+                stdout=stdout,
+                stderr=stderr,
+                text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            stdout.seek(0)
+            stderr.seek(0)
+            return stdout.read().strip(), stderr.read().strip(), usage
     except Exception as e:
-        return "", str(e)
+        return "", str(e), None
 
-def main():
-    with open("code_snippets.json", "r") as f:
-        test_cases = json.load(f)
+def run_case_subprocess(case):
+    """Run one case through the generate_z3.py command line, via temp files."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".py", mode='w') as tmp:
+        tmp.write(case["code"] + "\n")
+        tmp_path = tmp.name
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".py", mode='w') as tmp:
+        tmp.write(case["user_code"] + "\n")
+        user_tmp_path = tmp.name
 
-    for i, case in enumerate(test_cases):
-        code = case["code"]
-        user_code = case["user_code"]
-        variables = case["variables"]
-        name = case.get("name", f"Test_{i}")
+    try:
+        return run_generate_z3(tmp_path, user_tmp_path, case["variables"])
+    finally:
+        os.remove(tmp_path)
+        os.remove(user_tmp_path)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".py", mode='w') as tmp:
-            tmp.write(code + "\n")
-            tmp_path = tmp.name
+def run_case(case, timeout_ms=None, deadline_s=None):
+    """Run one case in this process; used as a pool job, so each worker has its own Z3 context."""
+    try:
+        result = check_equivalence(case["code"], case["user_code"], case["variables"],
+                                   timeout_ms=timeout_ms, deadline_s=deadline_s)
+        return json.dumps(result, indent=2), ""
+    except Exception as e:
+        return "", f"{type(e).__name__}: {e}"
 
+def report(test_cases, results):
+    for i, (case, (stdout, stderr, *_)) in enumerate(zip(test_cases, results)):
+        name = case.get("name", f"Test_{i}")
         print(f"\n=== Running {name} ===")
-        stdout, stderr = run_generate_z3(tmp_path, variables)
-
         if stderr:
             print("Error:\n", stderr)
         else:
             print("Output:\n", stdout)
 
-        os.remove(tmp_path)
+def main():
+    parser = argparse.ArgumentParser(description="Runs the equivalence checker on code_snippets.json")
+    parser.add_argument("--cases", default="code_snippets.json")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="run each case through the generate_z3.py command line instead of in-process")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--timeout-ms", type=int, default=5000, help="per solver call")
+    parser.add_argument("--deadline", type=float, default=None, help="seconds per case")
+    args = parser.parse_args()
+
+    with open(args.cases, "r") as f:
+        test_cases = json.load(f)
+
+    start = time.perf_counter()
+    if args.subprocess:
+        report(test_cases, map(run_case_subprocess, test_cases))
+    else:
+        run = partial(run_case, timeout_ms=args.timeout_ms, deadline_s=args.deadline)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            report(test_cases, pool.map(run, test_cases))
+    print(f"\n{len(test_cases)} cases in {time.perf_counter() - start:.2f}s")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,106 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import differential_testing
+from differential_testing import (SandboxOverrun, call_with_limit, compile_function, differential_check,
+                                  limit_worker_memory)
+
+TARGET = """
+def f(x):
+    return x + 1
+"""
+
+WRONG = """
+def f(x):
+    if x == 7:
+        return 0
+    return x + 1
+"""
+
+# Module-level code that reaches os through object's subclasses and marks the process it ran in
+ESCAPE = """
+_os = [c for c in ().__class__.__base__.__subclasses__() if c.__name__ == "_wrap_close"][0].__init__.__globals__
+_os["environ"]["DIFFERENTIAL_TEST_RAN_IN"] = str(_os["getpid"]())
+
+def f(x):
+    return x + 1
+"""
+
+# Catches the CallTimeout raised in it and carries on
+SWALLOWS_TIMEOUT = """
+def f(x):
+    while True:
+        try:
+            while True:
+                pass
+        except:
+            pass
+"""
+
+
+@pytest.fixture
+def sandbox():
+    pool = ProcessPoolExecutor(max_workers=2, initializer=limit_worker_memory)
+    yield pool
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def test_submission_only_runs_in_the_sandbox(sandbox, monkeypatch):
+    monkeypatch.delenv("DIFFERENTIAL_TEST_RAN_IN", raising=False)
+    tried, counterexample = differential_check(TARGET, ESCAPE, count=50, pool=sandbox)
+    assert tried > 0 and counterexample is None
+    assert "DIFFERENTIAL_TEST_RAN_IN" not in os.environ
+
+
+def test_submission_runs_in_process_without_a_sandbox(monkeypatch):
+    # The escape itself works, so the test above is meaningful
+    monkeypatch.delenv("DIFFERENTIAL_TEST_RAN_IN", raising=False)
+    differential_check(TARGET, ESCAPE, count=50)
+    assert os.environ["DIFFERENTIAL_TEST_RAN_IN"] == str(os.getpid())
+
+
+def test_syntax_errors_are_raised_in_the_caller(sandbox):
+    with pytest.raises(SyntaxError):
+        differential_check(TARGET, "def f(x):\n    return (", pool=sandbox)
+    with pytest.raises(ValueError):
+        differential_check(TARGET, "x = 1\n", pool=sandbox)
+
+
+def test_call_timeout_is_not_an_exception():
+    func = compile_function("""
+def f(x):
+    while True:
+        try:
+            x += 1
+        except Exception:
+            pass
+""")
+    assert call_with_limit(func, (1,), 0.05) == ("timeout", None)
+
+
+def test_swallowed_timeout_hits_the_cpu_limit(sandbox):
+    start = time.monotonic()
+    with pytest.raises(SandboxOverrun):
+        differential_check(TARGET, SWALLOWS_TIMEOUT, count=10, budget_s=0.5, pool=sandbox)
+    assert time.monotonic() - start < 10
+
+
+def test_swallowed_timeout_is_killed_from_outside(sandbox, monkeypatch):
+    # Without the CPU limit, differential_check kills the stuck process itself
+    monkeypatch.setattr(differential_testing, "SANDBOX_CPU_SLACK_S", 600.0)
+    start = time.monotonic()
+    with pytest.raises(SandboxOverrun):
+        differential_check(TARGET, SWALLOWS_TIMEOUT, count=10, budget_s=0.5, pool=sandbox)
+    assert time.monotonic() - start < 10
+
+
+def test_replaced_sandbox_still_finds_differences(sandbox):
+    with pytest.raises(BrokenProcessPool):
+        differential_check(TARGET, SWALLOWS_TIMEOUT, count=10, budget_s=0.5, pool=sandbox)
+    with ProcessPoolExecutor(max_workers=2, initializer=limit_worker_memory) as fresh:
+        _, counterexample = differential_check(TARGET, WRONG, seeds=[(7,)], pool=fresh)
+    assert counterexample["inputs"] == {"x": 7}
@@ -0,0 +1,149 @@
+import pytest
+
+import generate_z3
+from generate_z3 import check_equivalence
+
+TARGET = """
+def f(x):
+    if x > 0:
+        return x
+    return 0
+"""
+
+
+def check(user_src, target_src=TARGET):
+    return check_equivalence(target_src, user_src, deadline_s=10)
+
+
+@pytest.mark.parametrize("user_src", [
+    # An added raise
+    """
+def f(x):
+    if x > 5:
+        raise ValueError()
+    if x > 0:
+        return x
+    return 0
+""",
+    # An added assert
+    """
+def f(x):
+    assert x < 100
+    if x > 0:
+        return x
+    return 0
+""",
+    # A break that skips the assignment giving the right answer
+    """
+def f(x):
+    r = 0
+    for i in range(3):
+        if x > 0:
+            break
+        r = x
+    if x > 0:
+        return r + x
+    return r
+""",
+    # A try body whose assignment changes the result
+    """
+def f(x):
+    try:
+        x = x + 1
+    except ValueError:
+        pass
+    if x > 0:
+        return x
+    return 0
+""",
+    # An annotated reassignment
+    """
+def f(x):
+    y: int = 0
+    if x > 0:
+        y: int = x + 1
+    return y
+""",
+    # A deleted name that's read afterwards
+    """
+def f(x):
+    y = x
+    del y
+    if x > 0:
+        return y
+    return 0
+""",
+])
+def test_unmodelled_statements_are_never_equivalent(user_src):
+    result = check(user_src)
+    assert result["verdict"] != "equivalent"
+    assert result["verdict"] == "different" or result["method"] == "differential"
+
+
+@pytest.mark.parametrize("user_src", [
+    """
+def f(x):
+    if x > 5:
+        raise ValueError()
+    return 0
+""",
+    """
+def f(x):
+    try:
+        y = x
+    finally:
+        pass
+    return y
+""",
+    """
+def f(x):
+    with open("f") as fh:
+        pass
+    return x
+""",
+])
+def test_unmodelled_statements_fall_back_to_differential_testing(user_src):
+    result = check(user_src)
+    assert result["method"] == "differential"
+    assert result["verdict"] in ("different", "unknown")
+
+
+@pytest.mark.parametrize("user_src", [
+    """
+def f(x):
+    "Docstrings and pass don't change anything"
+    pass
+    if x > 0:
+        return x
+    return 0
+""",
+    """
+def f(x):
+    y: int = 0
+    if x > 0:
+        y: int = x
+    return y
+""",
+])
+def test_modelled_statements_are_equivalent(user_src):
+    result = check(user_src)
+    assert result["method"] == "symbolic"
+    assert result["verdict"] == "equivalent"
+
+
+def test_annotated_assignment_difference_has_counterexample():
+    result = check("""
+def f(x):
+    y: int = 0
+    if x > 0:
+        y: int = x + 1
+    return y
+""")
+    assert result["verdict"] == "different"
+    assert result["counterexample"]["inputs"]["x"] > 0
+
+
+def test_verdict_key_depends_on_engine_version(monkeypatch):
+    key = generate_z3.verdict_key(TARGET, TARGET)
+    monkeypatch.setattr(generate_z3, "ENGINE_VERSION", generate_z3.ENGINE_VERSION + 1)
+    assert generate_z3.verdict_key(TARGET, TARGET) != key
@@ -0,0 +1,91 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class VerdictCache:
+    """ File-backed cache of equivalence verdicts in SQLite, bounded by size.
+
+    Keys are hashes of the canonicalized target and user functions (see
+    generate_z3.canonical_function), so resubmitting the same code, or the
+    same code with renamed locals or reformatted, is a lookup. Keys also
+    include generate_z3.ENGINE_VERSION, so verdicts from an older checker
+    are never served and age out of the cache. When the stored results
+    grow past max_bytes the least recently used ones are evicted until the
+    cache is back under 90% of the limit.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A crash may lose the last few verdicts, which are only a cache
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS verdicts (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)")
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM verdicts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE verdicts SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        body = json.dumps(result)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)",
+                             (key, body, len(body), time.time()))
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM verdicts").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(total - int(self.max_bytes * 0.9))
+            self._db.commit()
+
+    def _evict(self, excess):
+        freed = 0
+        victims = []
+        for key, size in self._db.execute("SELECT key, size FROM verdicts ORDER BY last_used"):
+            if freed >= excess:
+                break
+            victims.append((key,))
+            freed += size
+        self._db.executemany("DELETE FROM verdicts WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM verdicts").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()